@@ -1,8 +1,24 @@
+import asyncio
 import base64
+import bisect
+import hashlib
+import io
+import itertools
+import json
+import logging
 import mimetypes
 import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Iterable, List
+from types import MappingProxyType
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Mapping
 
 
 def _strip_unsupported_proxy_env() -> None:
@@ -33,7 +49,17 @@ _set_gradio_language_env()
 
 import gradio as gr
 import yaml
-from claude_agent_sdk import query, ClaudeAgentOptions
+from claude_agent_sdk import query, ClaudeAgentOptions, ClaudeSDKClient, ResultMessage, Transport
+from claude_agent_sdk.types import StreamEvent
+from PIL import Image, ImageOps
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from knowledge import INDEX_FILE, KnowledgeIndex, Passage
+from plan_templates import PlanTemplate, PlanTemplateStore
+
+logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path(__file__).resolve().parent
 CONFIG_PATH = Path(os.getenv("RECOVERY_CONFIG_PATH", PROJECT_ROOT / "config.local.yaml"))
@@ -43,8 +69,93 @@ DEFAULT_CONFIG = {
     "model": "glm-4.7",
     "max_tokens": 1200,
     "max_image_bytes": 8000000,
+    "agent_pool_size": 16,
+    "agent_idle_seconds": 600,
+    "send_images": False,
+    "image_max_side": 1568,
+    "image_quality": 85,
+    "plan_cache_backend": "memory",
+    "plan_cache_path": ".cache/plan_cache.sqlite3",
+    "plan_cache_ttl_seconds": 3600,
+    "plan_cache_max_entries": 256,
+    "max_concurrent_requests": 8,
+    "max_requests_per_session": 2,
+    "max_queue_size": 32,
+    "history_token_budget": 2000,
+    "summary_token_budget": 600,
+    "prompt_cache_markers": False,
+    "speculative_plan": False,
+    "parallel_plan_sections": False,
+    "triage_continue": True,
+    "knowledge_index_path": "dist/knowledge_index",
+    "retrieval_top_k": 4,
+    "retrieval_budget_ms": 50,
+    "retrieval_max_chars": 1500,
+    "use_plan_templates": True,
+    "plan_templates_path": "dist/plan_templates.sqlite3",
+    "routes": {},
+    "request_timeout_seconds": 300,
+    "hedge_requests": False,
+    "hedge_min_samples": 20,
+    "hedge_delay_seconds": 10,
+    "circuit_breaker": True,
+    "breaker_window_seconds": 60,
+    "breaker_min_calls": 10,
+    "breaker_failure_ratio": 0.5,
+    "breaker_slow_call_seconds": 30,
+    "breaker_open_seconds": 30,
+    "fallback_base_url": "",
+    "fallback_model": "",
+    "fallback_api_key": "",
+    "metrics_endpoint": True,
+    "trace_dir": "",
+    "session_token_budget": 0,
+    "global_token_budget": 0,
+    "token_budget_window_seconds": 86400,
+    "budget_degrade_ratio": 0.8,
+    "degraded_model": "",
+    "degraded_max_tokens": 600,
 }
 
+ROUTE_NAMES = ("interview", "plan", "regenerate")
+ROUTE_ALIASES = {"speculative": "plan", "template": "plan", "batch": "plan"}
+CALL_PRIORITIES = {
+    "interview": 0,
+    "plan": 1,
+    "regenerate": 1,
+    "speculative": 2,
+    "template": 2,
+    "batch": 2,
+}
+
+SECTION_SESSION_MARK = ":section-"
+
+NO_REPLY_TEXT = "未收到模型回复。"
+BUSY_TEXT = "当前咨询人数较多，请稍后再试。"
+TIMEOUT_TEXT = "模型响应超时，请稍后重试。"
+BUDGET_TEXT = "本次咨询的模型用量已达上限，请稍后再试或联系管理员。"
+INCOMPLETE_PLAN_TEXT = "部分章节未能生成，请稍后重新生成方案。"
+UNAVAILABLE_TEXT = "模型服务暂时不可用，请稍后重试。"
+PLAN_REQUEST = (
+    "基于问诊信息生成最终的阶段化康复计划与临床建议，"
+    "包含进阶标准、回归运动清单与清晰的风险红旗。"
+    "如存在红旗症状，先给出紧急就医提示。"
+)
+PLAN_DELTA_REQUEST = (
+    "下面是与该运动员伤情最接近的基础康复方案模板（{label}）。"
+    "请结合运动员基本信息与问诊记录，只输出需要对模板做的个性化调整："
+    "需要修改、增加或删除的阶段内容、进阶标准与回归清单条目，以及针对该运动员的额外风险红旗；"
+    "模板中已适用的内容不要重复。如存在红旗症状，先给出紧急就医提示。"
+    "以二级标题“## 个性化调整”开头。\n\n基础方案模板:\n{plan}"
+)
+PLAN_SECTIONS = [
+    ("风险红旗与就医提示", "列出需要立即线下就医的红旗症状；如已存在红旗症状，先给出紧急就医提示"),
+    ("阶段化康复计划", "按阶段给出目标、训练内容与频次"),
+    ("进阶标准", "给出每个阶段进入下一阶段的客观标准"),
+    ("回归运动清单", "给出重返训练与比赛前需要逐项确认的清单"),
+    ("临床建议", "给出可能的原因、影像学检查考虑与就诊建议"),
+]
+
 SYSTEM_PROMPT = """You are a sports injury rehab assistant for athletes.
 You provide educational guidance only and are not a medical professional.
 Respond in Simplified Chinese.
@@ -287,6 +398,24 @@ select option {
 }
 """
 
+INJURY_REGIONS = [
+    "踝关节",
+    "膝关节",
+    "髋部",
+    "下背部",
+    "肩部",
+    "肘部",
+    "手腕或手",
+    "足部",
+    "腘绳肌",
+    "股四头肌",
+    "小腿",
+    "颈部",
+    "其他",
+]
+ONSET_TYPES = ["急性外伤", "过度使用", "不确定"]
+TRAINING_PHASES = ["赛季中", "休赛期", "季前备战", "回归训练"]
+
 SYMPTOM_OPTIONS = [
     "肿胀",
     "关节不稳",
@@ -309,6 +438,140 @@ RED_FLAG_SYMPTOMS = {
 }
 
 
+@dataclass(frozen=True)
+class TriageRule:
+    title: str
+    guidance: str
+    emergency: bool = False
+    symptoms: frozenset = frozenset()
+    regions: frozenset = frozenset()
+    onset_types: frozenset = frozenset()
+    min_pain: int | None = None
+
+    def matches(
+        self,
+        symptoms: frozenset,
+        pain_score: int,
+        onset_type: str,
+        injury_region: str,
+    ) -> bool:
+        if self.symptoms and not self.symptoms & symptoms:
+            return False
+        if self.regions and injury_region not in self.regions:
+            return False
+        if self.onset_types and onset_type not in self.onset_types:
+            return False
+        if self.min_pain is not None and pain_score < self.min_pain:
+            return False
+        return True
+
+
+TRIAGE_RULES = [
+    TriageRule(
+        title="颈部受伤伴麻木或刺痛",
+        guidance="可能累及脊髓或神经根。请保持颈部固定、不要自行活动或搬动，立即呼叫急救。",
+        emergency=True,
+        symptoms=frozenset({"麻木或刺痛"}),
+        regions=frozenset({"颈部"}),
+    ),
+    TriageRule(
+        title="头部受伤相关症状",
+        guidance="需排除脑震荡或颅内损伤。立即停止训练与比赛，当天不得回场，尽快急诊评估。",
+        emergency=True,
+        symptoms=frozenset({"头部受伤相关症状"}),
+    ),
+    TriageRule(
+        title="明显畸形",
+        guidance="可能存在骨折或脱位。请制动伤处、避免负重或自行复位，立即前往急诊。",
+        emergency=True,
+        symptoms=frozenset({"明显畸形"}),
+    ),
+    TriageRule(
+        title="开放性伤口或出血",
+        guidance="请加压止血并保持伤口清洁，立即就医处理伤口并评估是否需要破伤风预防。",
+        emergency=True,
+        symptoms=frozenset({"开放性伤口或出血"}),
+    ),
+    TriageRule(
+        title="下背部伤痛伴麻木或刺痛",
+        guidance="如伴随会阴区麻木或大小便异常，可能为马尾综合征，请立即急诊。",
+        emergency=True,
+        symptoms=frozenset({"麻木或刺痛"}),
+        regions=frozenset({"下背部"}),
+    ),
+    TriageRule(
+        title="发热或寒战",
+        guidance="需警惕感染（如关节或软组织感染），请当天线下就医。",
+        symptoms=frozenset({"发热或寒战"}),
+    ),
+    TriageRule(
+        title="无法负重",
+        guidance="伤后无法行走或负重提示可能骨折或严重韧带损伤，请尽快就医并完善影像学检查。",
+        symptoms=frozenset({"无法负重"}),
+    ),
+    TriageRule(
+        title="麻木或刺痛",
+        guidance="提示可能的神经受压或损伤，请尽快线下评估神经功能。",
+        symptoms=frozenset({"麻木或刺痛"}),
+    ),
+    TriageRule(
+        title="急性外伤后剧烈疼痛",
+        guidance="疼痛评分 8 分及以上的急性外伤需排除骨折、脱位或完全撕裂，请尽快就医。",
+        onset_types=frozenset({"急性外伤"}),
+        min_pain=8,
+    ),
+]
+
+
+def _triage(
+    symptoms: Iterable[str],
+    pain_score: int,
+    onset_type: str,
+    injury_region: str,
+) -> List[TriageRule]:
+    reported = frozenset(symptoms or [])
+    pain = _parse_int(pain_score, 0)
+    matched = [
+        rule
+        for rule in TRIAGE_RULES
+        if rule.matches(reported, pain, onset_type or "", injury_region or "")
+    ]
+    # A region-specific rule already covers its symptoms; drop the generic one.
+    covered = frozenset().union(*(rule.symptoms for rule in matched if rule.regions))
+    return [
+        rule
+        for rule in matched
+        if rule.regions or not rule.symptoms or not rule.symptoms <= covered
+    ]
+
+
+TRIAGE_HEADINGS = ("## 请立即线下就医", "## 请尽快线下就医")
+TRIAGE_SEPARATOR = "\n\n---\n\n"
+
+
+def _render_triage(matches: List[TriageRule]) -> str:
+    if not matches:
+        return ""
+    emergency = any(rule.emergency for rule in matches)
+    heading = TRIAGE_HEADINGS[0] if emergency else TRIAGE_HEADINGS[1]
+    lines = [heading, "", "根据你填写的信息，存在以下需要线下评估的红旗情况："]
+    lines.extend(f"- **{rule.title}**：{rule.guidance}" for rule in matches)
+    lines.extend(
+        [
+            "",
+            "在完成线下评估前，请停止训练与比赛。以下内容仅供参考，不能替代面诊。",
+        ]
+    )
+    return "\n".join(lines)
+
+
+def _strip_triage(text: str) -> str:
+    if not text.startswith(TRIAGE_HEADINGS):
+        return text
+    _, separator, rest = text.partition(TRIAGE_SEPARATOR)
+    return rest if separator else ""
+
+
 def _load_config_file() -> tuple[dict, str | None]:
     if not CONFIG_PATH.exists():
         return {}, None
@@ -328,8 +591,173 @@ def _parse_int(value: object, fallback: int) -> int:
         return fallback
 
 
-def _runtime_config() -> dict:
-    config, _ = _load_config_file()
+def _parse_float(value: object, fallback: float) -> float:
+    try:
+        return float(value)  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        return fallback
+
+
+def _parse_bool(value: object, fallback: bool) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("1", "true", "yes", "on"):
+            return True
+        if lowered in ("0", "false", "no", "off"):
+            return False
+    return fallback
+
+
+@dataclass(frozen=True)
+class RouteConfig:
+    model: str
+    max_tokens: int
+    timeout_seconds: int
+
+
+def _parse_routes(value: object, model: str, max_tokens: int) -> Mapping[str, RouteConfig]:
+    raw_routes = value if isinstance(value, dict) else {}
+    routes: dict[str, RouteConfig] = {}
+    for name in ROUTE_NAMES:
+        raw = raw_routes.get(name)
+        if raw is None and name == "regenerate":
+            raw = raw_routes.get("plan")
+        raw = raw if isinstance(raw, dict) else {}
+        routes[name] = RouteConfig(
+            model=str(raw.get("model") or model),
+            max_tokens=_parse_int(raw.get("max_tokens"), max_tokens),
+            timeout_seconds=_parse_int(raw.get("timeout_seconds"), 0),
+        )
+    return MappingProxyType(routes)
+
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    api_key: str
+    base_url: str
+    model: str
+    max_tokens: int
+    max_image_bytes: int
+    agent_pool_size: int
+    agent_idle_seconds: int
+    send_images: bool
+    image_max_side: int
+    image_quality: int
+    plan_cache_backend: str
+    plan_cache_path: str
+    plan_cache_ttl_seconds: int
+    plan_cache_max_entries: int
+    max_concurrent_requests: int
+    max_requests_per_session: int
+    max_queue_size: int
+    history_token_budget: int
+    summary_token_budget: int
+    prompt_cache_markers: bool
+    speculative_plan: bool
+    parallel_plan_sections: bool
+    triage_continue: bool
+    knowledge_index_path: str
+    retrieval_top_k: int
+    retrieval_budget_ms: int
+    retrieval_max_chars: int
+    use_plan_templates: bool
+    plan_templates_path: str
+    routes: Mapping[str, RouteConfig]
+    request_timeout_seconds: int
+    hedge_requests: bool
+    hedge_min_samples: int
+    hedge_delay_seconds: float
+    circuit_breaker: bool
+    breaker_window_seconds: int
+    breaker_min_calls: int
+    breaker_failure_ratio: float
+    breaker_slow_call_seconds: float
+    breaker_open_seconds: int
+    fallback_base_url: str
+    fallback_model: str
+    fallback_api_key: str
+    metrics_endpoint: bool
+    trace_dir: str
+    session_token_budget: int
+    global_token_budget: int
+    token_budget_window_seconds: int
+    budget_degrade_ratio: float
+    degraded_model: str
+    degraded_max_tokens: int
+    error: str | None = None
+
+
+@dataclass(frozen=True)
+class BackendConfig:
+    api_key: str
+    base_url: str
+    model: str
+    max_tokens: int
+
+    @classmethod
+    def from_runtime(cls, config: RuntimeConfig, route: str | None = None) -> "BackendConfig":
+        route_config = config.routes.get(route) if route else None
+        model = route_config.model if route_config else config.model
+        max_tokens = route_config.max_tokens if route_config else config.max_tokens
+        if model == config.model:
+            model = os.getenv("ANTHROPIC_MODEL") or model
+        if max_tokens == config.max_tokens:
+            max_tokens = _parse_int(os.getenv("ANTHROPIC_MAX_TOKENS"), max_tokens)
+        return cls(
+            api_key=config.api_key,
+            base_url=os.getenv("ANTHROPIC_BASE_URL") or config.base_url,
+            model=model,
+            max_tokens=max_tokens,
+        )
+
+    def fallback(self, config: RuntimeConfig) -> "BackendConfig | None":
+        if not config.fallback_base_url and not config.fallback_model:
+            return None
+        return replace(
+            self,
+            api_key=config.fallback_api_key or self.api_key,
+            base_url=config.fallback_base_url or self.base_url,
+            model=config.fallback_model or self.model,
+        )
+
+    @property
+    def label(self) -> str:
+        return _backend_label(self.model, self.base_url)
+
+    def env(self) -> dict[str, str]:
+        values = {
+            "ANTHROPIC_API_KEY": self.api_key,
+            "ANTHROPIC_BASE_URL": self.base_url,
+            "ANTHROPIC_MODEL": self.model,
+            "ANTHROPIC_MAX_TOKENS": str(self.max_tokens) if self.max_tokens else "",
+        }
+        return {key: value for key, value in values.items() if value}
+
+
+def _backend_label(model: str | None, base_url: str | None) -> str:
+    return f"{model or 'default'}@{base_url or 'default'}"
+
+
+def _route_name(call_type: str) -> str:
+    route = ROUTE_ALIASES.get(call_type, call_type)
+    return route if route in ROUTE_NAMES else "plan"
+
+
+CONFIG_ENV_KEYS = (
+    "ANTHROPIC_API_KEY",
+    "ZHIPUAI_API_KEY",
+    "BIGMODEL_BASE_URL",
+    "BIGMODEL_MODEL",
+    "BIGMODEL_MAX_TOKENS",
+    "BIGMODEL_MAX_IMAGE_BYTES",
+)
+_CONFIG_CACHE: tuple[tuple, RuntimeConfig] | None = None
+
+
+def _load_runtime_config() -> RuntimeConfig:
+    config, error = _load_config_file()
     merged = DEFAULT_CONFIG.copy()
     merged.update(config)
     env_key = os.getenv("ANTHROPIC_API_KEY") or os.getenv("ZHIPUAI_API_KEY")
@@ -346,14 +774,204 @@ def _runtime_config() -> dict:
             os.getenv("BIGMODEL_MAX_IMAGE_BYTES"),
             merged["max_image_bytes"],
         )
-    merged["max_tokens"] = _parse_int(merged.get("max_tokens"), DEFAULT_CONFIG["max_tokens"])
-    merged["max_image_bytes"] = _parse_int(
-        merged.get("max_image_bytes"),
-        DEFAULT_CONFIG["max_image_bytes"],
+    return RuntimeConfig(
+        api_key=str(merged.get("api_key") or "").strip(),
+        base_url=str(merged.get("base_url") or ""),
+        model=str(merged.get("model") or ""),
+        max_tokens=_parse_int(merged.get("max_tokens"), DEFAULT_CONFIG["max_tokens"]),
+        max_image_bytes=_parse_int(
+            merged.get("max_image_bytes"),
+            DEFAULT_CONFIG["max_image_bytes"],
+        ),
+        agent_pool_size=_parse_int(
+            merged.get("agent_pool_size"),
+            DEFAULT_CONFIG["agent_pool_size"],
+        ),
+        agent_idle_seconds=_parse_int(
+            merged.get("agent_idle_seconds"),
+            DEFAULT_CONFIG["agent_idle_seconds"],
+        ),
+        send_images=_parse_bool(merged.get("send_images"), DEFAULT_CONFIG["send_images"]),
+        image_max_side=_parse_int(merged.get("image_max_side"), DEFAULT_CONFIG["image_max_side"]),
+        image_quality=_parse_int(merged.get("image_quality"), DEFAULT_CONFIG["image_quality"]),
+        plan_cache_backend=str(merged.get("plan_cache_backend") or "off").strip().lower(),
+        plan_cache_path=str(merged.get("plan_cache_path") or DEFAULT_CONFIG["plan_cache_path"]),
+        plan_cache_ttl_seconds=_parse_int(
+            merged.get("plan_cache_ttl_seconds"),
+            DEFAULT_CONFIG["plan_cache_ttl_seconds"],
+        ),
+        plan_cache_max_entries=_parse_int(
+            merged.get("plan_cache_max_entries"),
+            DEFAULT_CONFIG["plan_cache_max_entries"],
+        ),
+        max_concurrent_requests=_parse_int(
+            merged.get("max_concurrent_requests"),
+            DEFAULT_CONFIG["max_concurrent_requests"],
+        ),
+        max_requests_per_session=_parse_int(
+            merged.get("max_requests_per_session"),
+            DEFAULT_CONFIG["max_requests_per_session"],
+        ),
+        max_queue_size=_parse_int(
+            merged.get("max_queue_size"),
+            DEFAULT_CONFIG["max_queue_size"],
+        ),
+        history_token_budget=_parse_int(
+            merged.get("history_token_budget"),
+            DEFAULT_CONFIG["history_token_budget"],
+        ),
+        summary_token_budget=_parse_int(
+            merged.get("summary_token_budget"),
+            DEFAULT_CONFIG["summary_token_budget"],
+        ),
+        prompt_cache_markers=_parse_bool(
+            merged.get("prompt_cache_markers"),
+            DEFAULT_CONFIG["prompt_cache_markers"],
+        ),
+        speculative_plan=_parse_bool(
+            merged.get("speculative_plan"),
+            DEFAULT_CONFIG["speculative_plan"],
+        ),
+        parallel_plan_sections=_parse_bool(
+            merged.get("parallel_plan_sections"),
+            DEFAULT_CONFIG["parallel_plan_sections"],
+        ),
+        triage_continue=_parse_bool(
+            merged.get("triage_continue"),
+            DEFAULT_CONFIG["triage_continue"],
+        ),
+        knowledge_index_path=str(
+            merged.get("knowledge_index_path") or DEFAULT_CONFIG["knowledge_index_path"]
+        ),
+        retrieval_top_k=_parse_int(
+            merged.get("retrieval_top_k"),
+            DEFAULT_CONFIG["retrieval_top_k"],
+        ),
+        retrieval_budget_ms=_parse_int(
+            merged.get("retrieval_budget_ms"),
+            DEFAULT_CONFIG["retrieval_budget_ms"],
+        ),
+        retrieval_max_chars=_parse_int(
+            merged.get("retrieval_max_chars"),
+            DEFAULT_CONFIG["retrieval_max_chars"],
+        ),
+        use_plan_templates=_parse_bool(
+            merged.get("use_plan_templates"),
+            DEFAULT_CONFIG["use_plan_templates"],
+        ),
+        plan_templates_path=str(
+            merged.get("plan_templates_path") or DEFAULT_CONFIG["plan_templates_path"]
+        ),
+        routes=_parse_routes(
+            merged.get("routes"),
+            str(merged.get("model") or ""),
+            _parse_int(merged.get("max_tokens"), DEFAULT_CONFIG["max_tokens"]),
+        ),
+        request_timeout_seconds=_parse_int(
+            merged.get("request_timeout_seconds"),
+            DEFAULT_CONFIG["request_timeout_seconds"],
+        ),
+        hedge_requests=_parse_bool(
+            merged.get("hedge_requests"),
+            DEFAULT_CONFIG["hedge_requests"],
+        ),
+        hedge_min_samples=_parse_int(
+            merged.get("hedge_min_samples"),
+            DEFAULT_CONFIG["hedge_min_samples"],
+        ),
+        hedge_delay_seconds=_parse_float(
+            merged.get("hedge_delay_seconds"),
+            DEFAULT_CONFIG["hedge_delay_seconds"],
+        ),
+        circuit_breaker=_parse_bool(
+            merged.get("circuit_breaker"),
+            DEFAULT_CONFIG["circuit_breaker"],
+        ),
+        breaker_window_seconds=_parse_int(
+            merged.get("breaker_window_seconds"),
+            DEFAULT_CONFIG["breaker_window_seconds"],
+        ),
+        breaker_min_calls=_parse_int(
+            merged.get("breaker_min_calls"),
+            DEFAULT_CONFIG["breaker_min_calls"],
+        ),
+        breaker_failure_ratio=_parse_float(
+            merged.get("breaker_failure_ratio"),
+            DEFAULT_CONFIG["breaker_failure_ratio"],
+        ),
+        breaker_slow_call_seconds=_parse_float(
+            merged.get("breaker_slow_call_seconds"),
+            DEFAULT_CONFIG["breaker_slow_call_seconds"],
+        ),
+        breaker_open_seconds=_parse_int(
+            merged.get("breaker_open_seconds"),
+            DEFAULT_CONFIG["breaker_open_seconds"],
+        ),
+        fallback_base_url=str(merged.get("fallback_base_url") or ""),
+        fallback_model=str(merged.get("fallback_model") or ""),
+        fallback_api_key=str(merged.get("fallback_api_key") or "").strip(),
+        metrics_endpoint=_parse_bool(
+            merged.get("metrics_endpoint"),
+            DEFAULT_CONFIG["metrics_endpoint"],
+        ),
+        trace_dir=str(merged.get("trace_dir") or ""),
+        session_token_budget=_parse_int(
+            merged.get("session_token_budget"),
+            DEFAULT_CONFIG["session_token_budget"],
+        ),
+        global_token_budget=_parse_int(
+            merged.get("global_token_budget"),
+            DEFAULT_CONFIG["global_token_budget"],
+        ),
+        token_budget_window_seconds=_parse_int(
+            merged.get("token_budget_window_seconds"),
+            DEFAULT_CONFIG["token_budget_window_seconds"],
+        ),
+        budget_degrade_ratio=_parse_float(
+            merged.get("budget_degrade_ratio"),
+            DEFAULT_CONFIG["budget_degrade_ratio"],
+        ),
+        degraded_model=str(merged.get("degraded_model") or ""),
+        degraded_max_tokens=_parse_int(
+            merged.get("degraded_max_tokens"),
+            DEFAULT_CONFIG["degraded_max_tokens"],
+        ),
+        error=error,
     )
-    return merged
 
 
+def _config_stamp() -> tuple:
+    try:
+        stat = CONFIG_PATH.stat()
+        file_stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        file_stamp = None
+    return file_stamp, tuple(os.getenv(key) for key in CONFIG_ENV_KEYS)
+
+
+def _runtime_config() -> RuntimeConfig:
+    global _CONFIG_CACHE
+    stamp = _config_stamp()
+    cached = _CONFIG_CACHE
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    config = _load_runtime_config()
+    _CONFIG_CACHE = (stamp, config)
+    return config
+
+
+def _reload_runtime_config() -> RuntimeConfig:
+    global _CONFIG_CACHE
+    _CONFIG_CACHE = None
+    return _runtime_config()
+
+
+def _handle_reload_signal(signum: int, frame: object) -> None:
+    config = _reload_runtime_config()
+    if config.error:
+        logger.warning("Config reload failed: %s", config.error)
+    else:
+        logger.info("Config reloaded from %s", CONFIG_PATH)
 
 
 def _format_list(values: Iterable[str]) -> str:
@@ -430,172 +1048,1673 @@ def _build_intake(
 
 
 def _get_api_key() -> str:
-    return str(_runtime_config().get("api_key", "")).strip()
+    return _runtime_config().api_key
+
+
+@dataclass(frozen=True)
+class ImageAttachment:
+    path: str
+    size: int
+    media_type: str
+    mtime_ns: int = 0
+
+    def to_payload(self, max_side: int, quality: int) -> dict:
+        return _IMAGE_CACHE.payload(self, max_side, quality)
+
+
+@dataclass(frozen=True)
+class _ProcessedImage:
+    payload: dict
+    original_bytes: int
+    encoded_bytes: int
+
+
+def _downscale_image(data: bytes, max_side: int, quality: int) -> tuple[bytes, str]:
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if max_side > 0:
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "P"):
+            image.save(output, format="PNG", optimize=True)
+            return output.getvalue(), "image/png"
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue(), "image/jpeg"
+
+
+class _ImageCache:
+    def __init__(self, max_entries: int = 32) -> None:
+        self._max_entries = max_entries
+        self._digests: dict[tuple[str, int, int], str] = {}
+        self._entries: OrderedDict[tuple[str, int, int], _ProcessedImage] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def _digest(self, image: ImageAttachment) -> tuple[str, bytes | None]:
+        file_key = (image.path, image.size, image.mtime_ns)
+        with self._lock:
+            digest = self._digests.get(file_key)
+        data = None
+        if digest is None:
+            with open(image.path, "rb") as handle:
+                data = handle.read()
+            digest = hashlib.sha256(data).hexdigest()
+            with self._lock:
+                self._digests[file_key] = digest
+                while len(self._digests) > self._max_entries * 4:
+                    self._digests.pop(next(iter(self._digests)))
+        return digest, data
+
+    def payload(self, image: ImageAttachment, max_side: int, quality: int) -> dict:
+        digest, data = self._digest(image)
+        key = (digest, max_side, quality)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += cached.original_bytes - cached.encoded_bytes
+                return cached.payload
+        if data is None:
+            with open(image.path, "rb") as handle:
+                data = handle.read()
+        encoded, media_type = _downscale_image(data, max_side, quality)
+        if len(encoded) >= len(data):
+            encoded, media_type = data, image.media_type
+        processed = _ProcessedImage(
+            payload={
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": media_type,
+                    "data": base64.b64encode(encoded).decode("ascii"),
+                },
+            },
+            original_bytes=len(data),
+            encoded_bytes=len(encoded),
+        )
+        with self._lock:
+            self._entries[key] = processed
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self.misses += 1
+            self.bytes_saved += processed.original_bytes - processed.encoded_bytes
+            bytes_saved = self.bytes_saved
+        logger.info(
+            "Image %s processed: %d -> %d bytes (%d saved in total)",
+            digest[:12],
+            processed.original_bytes,
+            processed.encoded_bytes,
+            bytes_saved,
+        )
+        return processed.payload
+
+
+_IMAGE_CACHE = _ImageCache()
 
 
 def _build_image_payload(
     image_path: str | None,
     max_bytes: int,
-) -> tuple[dict | None, str | None]:
+) -> tuple[ImageAttachment | None, str | None]:
     if not image_path:
         return None, None
     try:
-        if not os.path.exists(image_path):
-            return None, "未找到图片路径，将继续进行但不使用图片。"
-        size = os.path.getsize(image_path)
-        if size > max_bytes:
-            return None, "图片过大，将继续进行但不使用图片。"
-        media_type = mimetypes.guess_type(image_path)[0]
-        if not media_type or not media_type.startswith("image/"):
-            return None, "不支持的图片格式，请上传 PNG 或 JPG。"
-        with open(image_path, "rb") as handle:
-            data = base64.b64encode(handle.read()).decode("ascii")
-        payload = {
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": media_type,
-                "data": data,
-            },
-        }
-        return payload, None
-    except Exception:
+        stat = os.stat(image_path)
+    except FileNotFoundError:
+        return None, "未找到图片路径，将继续进行但不使用图片。"
+    except OSError:
         return None, "图片加载失败，将继续进行但不使用图片。"
+    if stat.st_size > max_bytes:
+        return None, "图片过大，将继续进行但不使用图片。"
+    media_type = mimetypes.guess_type(image_path)[0]
+    if not media_type or not media_type.startswith("image/"):
+        return None, "不支持的图片格式，请上传 PNG 或 JPG。"
+    attachment = ImageAttachment(
+        path=image_path,
+        size=stat.st_size,
+        media_type=media_type,
+        mtime_ns=stat.st_mtime_ns,
+    )
+    return attachment, None
 
 
-def _build_messages(
-    history: List[List[str]],
-    user_message: str,
-    image_payload: dict | None = None,
-) -> List[dict]:
-    messages: List[dict] = []
-    for user_text, assistant_text in (history or [])[-6:]:
-        if user_text:
-            messages.append({"role": "user", "content": user_text})
-        if assistant_text:
-            messages.append({"role": "assistant", "content": assistant_text})
-    if image_payload:
-        content = [{"type": "text", "text": user_message}, image_payload]
-        messages.append({"role": "user", "content": content})
-    else:
-        messages.append({"role": "user", "content": user_message})
-    if messages and messages[0]["role"] == "assistant":
-        messages.insert(0, {"role": "user", "content": "已提供基础信息，请开始问诊。"})
-    return messages
+def _user_message_stream(content: List[dict]) -> AsyncIterator[dict]:
+    async def _stream() -> AsyncIterator[dict]:
+        yield {
+            "type": "user",
+            "message": {"role": "user", "content": content},
+            "parent_tool_use_id": None,
+            "session_id": "default",
+        }
 
+    return _stream()
 
-def _extract_response_text(response: object) -> str:
-    content = getattr(response, "content", None)
-    if not content:
-        return ""
+
+INTERVIEW_OPENER = "已提供基础信息，请开始问诊。"
+SUMMARY_HEADER = "Summary of earlier conversation:"
+
+
+def _estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    wide = sum(1 for char in text if ord(char) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _clip(text: object, limit: int) -> str:
+    collapsed = " ".join(str(text or "").split())
+    return collapsed if len(collapsed) <= limit else collapsed[: limit - 1] + "…"
+
+
+def _summarize_turn(user_text: object, assistant_text: object) -> str:
     parts = []
-    for block in content:
-        text = getattr(block, "text", None)
-        if isinstance(text, str):
-            parts.append(text)
-        elif isinstance(block, dict) and isinstance(block.get("text"), str):
-            parts.append(block["text"])
-    return "".join(parts).strip()
-
-
-def _strip_images_from_messages(messages: List[dict]) -> List[dict]:
-    stripped = []
-    for message in messages:
-        content = message.get("content")
-        if isinstance(content, list):
-            text_parts = []
-            for block in content:
-                if isinstance(block, dict) and block.get("type") == "text":
-                    text_parts.append(block.get("text", ""))
-            content = "".join(text_parts).strip()
-        stripped.append({"role": message.get("role", "user"), "content": content})
-    return stripped
-
-
-def _message_content_to_text(content: object) -> str:
+    if user_text:
+        parts.append(f"问：{' '.join(str(user_text).split())}")
+    if assistant_text:
+        answer = " ".join(str(assistant_text).split())
+        if len(answer) > 60:
+            answer = _clip(answer, 60) + "（回答已截断）"
+        parts.append(f"答：{answer}")
+    return "- " + "；".join(parts) if parts else ""
+
+
+def _render_line(role: str, content: object) -> str:
+    if isinstance(content, list):
+        text = "".join(
+            str(block.get("text", ""))
+            for block in content
+            if isinstance(block, dict) and block.get("type") == "text"
+        ).strip()
+    else:
+        text = "" if content is None else str(content).strip()
+    return f"{role.capitalize()}: {text}" if text else ""
+
+
+def _render_prefix(system_prompt: str, intake: str, references: str = "") -> str:
+    prefix = f"{system_prompt.strip()}\n\n运动员基本信息:\n{intake}"
+    if references:
+        prefix = f"{prefix}\n\n参考资料（本地知识库检索，仅供参考）:\n{references}"
+    return prefix
+
+
+def _render_prompt(prefix: str, history_lines: List[str], user_message: str) -> tuple[str, str, str]:
+    history = "\n".join(["Conversation:"] + [line for line in history_lines if line])
+    turn_lines = [_render_line("user", user_message), "Assistant:"]
+    turn = "\n".join(line for line in turn_lines if line)
+    return prefix, history, turn
+
+
+def _prompt_text(segments: tuple[str, str, str]) -> str:
+    prefix, history, turn = segments
+    return f"{prefix}\n\n{history}\n{turn}".strip()
+
+
+def _prompt_content(segments: tuple[str, str, str], cache_markers: bool) -> List[dict]:
+    prefix, history, turn = segments
+    blocks = []
+    for text, cacheable in ((f"{prefix}\n\n", True), (f"{history}\n", True), (turn, False)):
+        block: dict = {"type": "text", "text": text}
+        if cache_markers and cacheable:
+            block["cache_control"] = {"type": "ephemeral"}
+        blocks.append(block)
+    return blocks
+
+
+class _KnowledgeStore:
+    def __init__(self, max_entries: int = 256) -> None:
+        self._index: KnowledgeIndex | None = None
+        self._stamp: tuple | None = None
+        self._results: OrderedDict[tuple, str] = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._searching = 0
+        self._retired: List[KnowledgeIndex] = []
+
+    @staticmethod
+    def _index_path(config: RuntimeConfig) -> Path:
+        path = Path(config.knowledge_index_path)
+        return path if path.is_absolute() else PROJECT_ROOT / path
+
+    @staticmethod
+    def _index_stamp(path: Path) -> tuple | None:
+        try:
+            stat = (path / INDEX_FILE).stat()
+        except OSError:
+            return None
+        return str(path), stat.st_mtime_ns, stat.st_size
+
+    def _load(self, path: Path) -> KnowledgeIndex | None:
+        stamp = self._index_stamp(path)
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._results.clear()
+            if self._index is not None:
+                self._retired.append(self._index)
+                self._close_retired()
+            self._index = None
+            if stamp is not None:
+                try:
+                    self._index = KnowledgeIndex(path)
+                    logger.info(
+                        "Loaded knowledge index %s (%d chunks)", path, self._index.chunk_count
+                    )
+                except Exception:
+                    logger.exception("Failed to load knowledge index %s", path)
+        return self._index
+
+    def _close_retired(self) -> None:
+        if self._searching:
+            return
+        while self._retired:
+            self._retired.pop().close()
+
+    def version(self, config: RuntimeConfig) -> str:
+        if config.retrieval_top_k <= 0:
+            return ""
+        stamp = self._index_stamp(self._index_path(config))
+        return f"{stamp[1]}:{stamp[2]}" if stamp else ""
+
+    def references(self, query_text: str, config: RuntimeConfig) -> str:
+        if config.retrieval_top_k <= 0 or not query_text.strip():
+            return ""
+        key = (
+            query_text,
+            config.retrieval_top_k,
+            config.retrieval_budget_ms,
+            config.retrieval_max_chars,
+        )
+        with self._lock:
+            index = self._load(self._index_path(config))
+            if index is None:
+                return ""
+            cached = self._results.get(key)
+            if cached is not None:
+                self._results.move_to_end(key)
+                return cached
+            self._searching += 1
+        started = time.perf_counter()
+        try:
+            passages = index.search(
+                query_text,
+                top_k=config.retrieval_top_k,
+                budget_ms=config.retrieval_budget_ms,
+            )
+            text = _render_references(passages, config.retrieval_max_chars)
+        finally:
+            with self._lock:
+                self._searching -= 1
+                self._close_retired()
+        logger.info(
+            "Retrieved %d passages for %r in %.1f ms",
+            len(passages),
+            query_text,
+            (time.perf_counter() - started) * 1000,
+        )
+        with self._lock:
+            if self._index is index:
+                self._results[key] = text
+                while len(self._results) > self._max_entries:
+                    self._results.popitem(last=False)
+        return text
+
+
+def _render_references(passages: List[Passage], max_chars: int) -> str:
+    lines: List[str] = []
+    remaining = max_chars
+    for number, passage in enumerate(passages, start=1):
+        if remaining <= 0:
+            break
+        text = _clip(passage.text, remaining)
+        remaining -= len(text)
+        lines.append(f"[{number}] ({passage.source}) {text}")
+    return "\n".join(lines)
+
+
+_KNOWLEDGE = _KnowledgeStore()
+
+
+def _retrieval_query(injury_region: str, injury_type: str) -> str:
+    return " ".join(
+        value.strip() for value in (injury_region, injury_type) if value and value.strip()
+    )
+
+
+class _Conversation:
+    def __init__(self) -> None:
+        self._consumed = 0
+        self._last_item: object = None
+        self._pending_user: str | None = None
+        self._turns: List[tuple[str, str, tuple[str, str], int]] = []
+        self._summarized = 0
+        self._summary: List[tuple[str, int]] = []
+        self._intake_key: tuple | None = None
+        self._prefix = ""
+
+    def _reset(self) -> None:
+        self._consumed = 0
+        self._last_item = None
+        self._pending_user = None
+        self._turns = []
+        self._summarized = 0
+        self._summary = []
+
+    @staticmethod
+    def _make_turn(user_text: str, assistant_text: str) -> tuple[str, str, tuple[str, str], int]:
+        lines = (_render_line("user", user_text), _render_line("assistant", assistant_text))
+        return user_text, assistant_text, lines, sum(_estimate_tokens(line) for line in lines)
+
+    def _add_turn(self, user_text: str, assistant_text: str) -> None:
+        self._turns.append(self._make_turn(user_text, assistant_text))
+
+    def _consume(self, item: object) -> None:
+        if isinstance(item, dict):
+            role = item.get("role")
+            content = item.get("content", "")
+            if role == "user":
+                if self._pending_user is not None:
+                    self._add_turn(self._pending_user, "")
+                self._pending_user = content
+            elif role == "assistant":
+                self._add_turn(self._pending_user or "", _strip_triage(content))
+                self._pending_user = None
+        elif isinstance(item, (list, tuple)) and len(item) >= 2:
+            self._add_turn(item[0], _strip_triage(item[1]))
+
+    def sync(self, history: List) -> None:
+        if len(history) < self._consumed or (
+            self._consumed and history[self._consumed - 1] != self._last_item
+        ):
+            self._reset()
+        for item in history[self._consumed:]:
+            self._consume(item)
+        self._consumed = len(history)
+        self._last_item = history[-1] if history else None
+
+    def turns(self) -> List[tuple[str, str, tuple[str, str], int]]:
+        if self._pending_user is None:
+            return self._turns
+        return self._turns + [self._make_turn(self._pending_user, "")]
+
+    def _summarize_until(self, end: int, summary_budget: int) -> None:
+        for user_text, assistant_text, _, _ in self._turns[self._summarized:end]:
+            entry = _summarize_turn(user_text, assistant_text)
+            if entry:
+                self._summary.append((entry, _estimate_tokens(entry)))
+        self._summarized = max(self._summarized, end)
+        total = sum(tokens for _, tokens in self._summary)
+        while self._summary and total > summary_budget:
+            total -= self._summary.pop(0)[1]
+
+    def history_lines(self, token_budget: int, summary_budget: int) -> List[str]:
+        turns = self.turns()
+        start = len(turns)
+        used = 0
+        for index in range(len(turns) - 1, -1, -1):
+            tokens = turns[index][3]
+            if start < len(turns) and used + tokens > token_budget:
+                break
+            used += tokens
+            start = index
+        self._summarize_until(min(start, len(self._turns)), summary_budget)
+        turns = turns[max(start, self._summarized):]
+        lines: List[str] = []
+        if self._summary:
+            lines.append("\n".join([SUMMARY_HEADER] + [entry for entry, _ in self._summary]))
+        for user_text, assistant_text, _, _ in turns:
+            if user_text:
+                break
+            if assistant_text:
+                lines.append(_render_line("user", INTERVIEW_OPENER))
+                break
+        for _, _, turn_lines, _ in turns:
+            lines.extend(turn_lines)
+        return lines
+
+    def prefix(self, system_prompt: str, values: tuple, references: str = "") -> str:
+        key = (system_prompt, values, references)
+        if key != self._intake_key:
+            self._intake_key = key
+            self._prefix = _render_prefix(system_prompt, _build_intake(*values), references)
+        return self._prefix
+
+
+_CONVERSATIONS: OrderedDict[str, _Conversation] = OrderedDict()
+MAX_CONVERSATIONS = 1024
+
+
+def _session_conversation(session_id: str | None) -> _Conversation:
+    if not session_id:
+        return _Conversation()
+    conversation = _CONVERSATIONS.get(session_id)
+    if conversation is None:
+        conversation = _Conversation()
+        _CONVERSATIONS[session_id] = conversation
+        while len(_CONVERSATIONS) > MAX_CONVERSATIONS:
+            _CONVERSATIONS.popitem(last=False)
+    _CONVERSATIONS.move_to_end(session_id)
+    return conversation
+
+
+def _event_text(event: object) -> str:
+    if isinstance(event, str):
+        return event
+    content = getattr(event, "content", None)
+    if isinstance(content, str):
+        return content
     if isinstance(content, list):
         parts = []
         for block in content:
-            if isinstance(block, dict) and block.get("type") == "text":
-                parts.append(str(block.get("text", "")))
-        return "".join(parts).strip()
-    if content is None:
+            if isinstance(block, dict):
+                text_part = block.get("text")
+            else:
+                text_part = getattr(block, "text", None)
+            if isinstance(text_part, str):
+                parts.append(text_part)
+        return "".join(parts)
+    text_part = getattr(event, "text", None)
+    if isinstance(text_part, str):
+        return text_part
+    return ""
+
+
+def _stream_event_text(event: StreamEvent) -> str:
+    payload = event.event if isinstance(event.event, dict) else {}
+    if payload.get("type") != "content_block_delta":
+        return ""
+    delta = payload.get("delta") or {}
+    if delta.get("type") != "text_delta":
         return ""
-    return str(content).strip()
+    text = delta.get("text")
+    return text if isinstance(text, str) else ""
+
+
+AGENT_TRANSPORT_FACTORY: (
+    Callable[[str | AsyncIterator[dict] | None, ClaudeAgentOptions], Transport] | None
+) = None
+
+
+def _agent_transport(
+    prompt: str | AsyncIterator[dict] | None,
+    options: ClaudeAgentOptions,
+) -> Transport | None:
+    if AGENT_TRANSPORT_FACTORY is None:
+        return None
+    return AGENT_TRANSPORT_FACTORY(prompt, options)
+
+
+AGENT_RESET_COMMAND = "/clear"
+AGENT_RESET_TIMEOUT_SECONDS = 10.0
+AGENT_INTERRUPT_TIMEOUT_SECONDS = 5.0
+
+
+class _PooledAgent:
+    def __init__(self, options: ClaudeAgentOptions) -> None:
+        self.options = options
+        self.fingerprint = _options_fingerprint(options)
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.closed = False
+        self.created_at = time.perf_counter()
+        self.connected_at: float | None = None
+        self._client: ClaudeSDKClient | None = None
+        self._active: asyncio.Queue | None = None
+        self._abandoned: set[int] = set()
+        self.interrupting: asyncio.Task | None = None
+        self._requests: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._serve())
+
+    async def _serve(self) -> None:
+        error: BaseException | None = None
+        try:
+            async with ClaudeSDKClient(
+                options=self.options,
+                transport=_agent_transport(None, self.options),
+            ) as client:
+                self._client = client
+                self.connected_at = time.perf_counter()
+                served = False
+                while True:
+                    item = await self._requests.get()
+                    if item is None:
+                        return
+                    prompt, replies = item
+                    if id(replies) in self._abandoned:
+                        self._abandoned.discard(id(replies))
+                        continue
+                    self._active = replies
+                    try:
+                        if served:
+                            await asyncio.wait_for(
+                                _drain_response(client, AGENT_RESET_COMMAND),
+                                AGENT_RESET_TIMEOUT_SECONDS,
+                            )
+                        served = True
+                        await client.query(prompt)
+                        async for event in client.receive_response():
+                            replies.put_nowait(event)
+                    except Exception as exc:
+                        self._active = None
+                        replies.put_nowait(exc)
+                        raise
+                    self._active = None
+                    self._abandoned.discard(id(replies))
+                    replies.put_nowait(None)
+        except Exception as exc:
+            error = exc
+        finally:
+            self.closed = True
+            self._client = None
+            if self._active is not None:
+                self._active.put_nowait(error or RuntimeError("Agent process closed."))
+            while not self._requests.empty():
+                item = self._requests.get_nowait()
+                if item is not None:
+                    item[1].put_nowait(error or RuntimeError("Agent process closed."))
+
+    async def run(self, prompt: str | AsyncIterator[dict]) -> AsyncIterator[object]:
+        replies: asyncio.Queue = asyncio.Queue()
+        self._requests.put_nowait((prompt, replies))
+        finished = False
+        try:
+            while True:
+                event = await replies.get()
+                if event is None:
+                    finished = True
+                    return
+                if isinstance(event, BaseException):
+                    finished = True
+                    raise event
+                yield event
+        finally:
+            if not finished:
+                self._abandon(replies)
+
+    def _abandon(self, replies: asyncio.Queue) -> None:
+        if self._active is not replies:
+            self._abandoned.add(id(replies))
+            return
+        self._abandoned.add(id(replies))
+        self.interrupting = asyncio.get_running_loop().create_task(self._interrupt(replies))
+
+    async def _interrupt(self, replies: asyncio.Queue) -> None:
+        client = self._client
+        if client is None:
+            return
+
+        async def _drain() -> None:
+            await client.interrupt()
+            event = await replies.get()
+            while event is not None and not isinstance(event, BaseException):
+                event = await replies.get()
 
+        try:
+            await asyncio.wait_for(_drain(), AGENT_INTERRUPT_TIMEOUT_SECONDS)
+            logger.info("Interrupted abandoned agent response.")
+        except Exception:
+            logger.warning("Agent interrupt failed; terminating agent process.", exc_info=True)
+            self.terminate()
+        finally:
+            self.interrupting = None
+
+    def close(self) -> None:
+        self.closed = True
+        self._requests.put_nowait(None)
+
+    def terminate(self) -> None:
+        self.close()
+        if self._active is not None:
+            self._task.cancel()
+
+
+async def _drain_response(client: ClaudeSDKClient, prompt: str) -> None:
+    await client.query(prompt)
+    async for _ in client.receive_response():
+        pass
+
+
+def _options_fingerprint(options: ClaudeAgentOptions) -> str:
+    return repr(
+        (
+            str(options.cwd),
+            options.setting_sources,
+            options.allowed_tools,
+            options.system_prompt,
+            options.model,
+            sorted(options.env.items()),
+            options.include_partial_messages,
+        )
+    )
 
-def _messages_to_prompt(system_prompt: str, messages: List[dict]) -> str:
-    lines = [system_prompt.strip(), "", "Conversation:"]
-    for message in messages:
-        role = message.get("role", "user")
-        content = _message_content_to_text(message.get("content", ""))
-        if not content:
-            continue
-        lines.append(f"{role.capitalize()}: {content}")
-    lines.append("Assistant:")
-    return "\n".join(lines).strip()
 
+class _AgentPool:
+    def __init__(self) -> None:
+        self._agents: OrderedDict[str, _PooledAgent] = OrderedDict()
+
+    def _evict(self, max_agents: int, idle_seconds: int) -> None:
+        now = time.monotonic()
+        for key, agent in list(self._agents.items()):
+            idle = not agent.lock.locked() and now - agent.last_used > idle_seconds
+            if agent.closed or idle:
+                self._agents.pop(key).close()
+        while len(self._agents) > max(max_agents, 0):
+            _, agent = self._agents.popitem(last=False)
+            agent.close()
+
+    async def stream(
+        self,
+        session_id: str,
+        options: ClaudeAgentOptions,
+        prompt: str | AsyncIterator[dict],
+        max_agents: int,
+        idle_seconds: int,
+        trace: "_Trace | None" = None,
+    ) -> AsyncIterator[object]:
+        self._evict(max_agents, idle_seconds)
+        agent = self._agents.get(session_id)
+        if agent is not None and agent.interrupting is not None:
+            await asyncio.wait({agent.interrupting})
+            agent = self._agents.get(session_id)
+        fresh = False
+        if agent is None or agent.closed or agent.fingerprint != _options_fingerprint(options):
+            if agent is not None:
+                agent.close()
+            agent = _PooledAgent(options)
+            self._agents[session_id] = agent
+            fresh = True
+        self._agents.move_to_end(session_id)
+        self._evict(max_agents, idle_seconds)
+        async with agent.lock:
+            agent.last_used = time.monotonic()
+            try:
+                async for event in agent.run(prompt):
+                    if fresh and trace is not None and agent.connected_at is not None:
+                        trace.record("agent_start", agent.created_at, agent.connected_at)
+                        fresh = False
+                    yield event
+            finally:
+                agent.last_used = time.monotonic()
+
+    def release(self, session_id: str) -> None:
+        for key in list(self._agents):
+            if key == session_id or key.startswith(f"{session_id}:"):
+                self._agents.pop(key).terminate()
+
+
+_AGENT_POOL = _AgentPool()
+
+
+def _agent_events(
+    prompt: str | AsyncIterator[dict],
+    options: ClaudeAgentOptions,
+    session_id: str | None,
+    config: RuntimeConfig,
+    trace: "_Trace | None" = None,
+) -> AsyncIterator[object]:
+    if not session_id or config.agent_pool_size <= 0:
+        return query(
+            prompt=prompt,
+            options=options,
+            transport=_agent_transport(prompt, options),
+        )
+    return _AGENT_POOL.stream(
+        session_id,
+        options,
+        prompt,
+        max_agents=config.agent_pool_size,
+        idle_seconds=config.agent_idle_seconds,
+        trace=trace,
+    )
 
 
+def _base_session_id(session_id: str | None) -> str | None:
+    return session_id.split(":", 1)[0] if session_id else None
 
-async def _run_agent(
-    system_prompt: str,
-    messages: List[dict],
-    had_image: bool,
-) -> str:
-    config = _runtime_config()
-    api_key = str(config.get("api_key", "")).strip()
-    if api_key and not os.getenv("ANTHROPIC_API_KEY"):
-        os.environ["ANTHROPIC_API_KEY"] = api_key
-    if config.get("base_url") and not os.getenv("ANTHROPIC_BASE_URL"):
-        os.environ["ANTHROPIC_BASE_URL"] = str(config.get("base_url"))
-    if config.get("model") and not os.getenv("ANTHROPIC_MODEL"):
-        os.environ["ANTHROPIC_MODEL"] = str(config.get("model"))
-    if config.get("max_tokens") and not os.getenv("ANTHROPIC_MAX_TOKENS"):
-        os.environ["ANTHROPIC_MAX_TOKENS"] = str(
-            _parse_int(config.get("max_tokens"), DEFAULT_CONFIG["max_tokens"])
+
+def _is_section_session(session_id: str | None) -> bool:
+    return bool(session_id) and SECTION_SESSION_MARK in session_id
+
+
+async def _release_session_agent(request: gr.Request) -> None:
+    if request and request.session_hash:
+        _AGENT_POOL.release(request.session_hash)
+        for key in list(_CONVERSATIONS):
+            if _base_session_id(key) == request.session_hash:
+                del _CONVERSATIONS[key]
+        _SPECULATOR.cancel(request.session_hash)
+        _USAGE.release(request.session_hash)
+
+
+def _usage_tokens(usage: dict | None) -> tuple[int, int]:
+    usage = usage or {}
+    input_tokens = sum(
+        _parse_int(usage.get(key), 0)
+        for key in ("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+    )
+    return input_tokens, _parse_int(usage.get("output_tokens"), 0)
+
+
+class _UsageLedger:
+    def __init__(self, max_sessions: int = 4096) -> None:
+        self._max_sessions = max_sessions
+        self._sessions: OrderedDict[str, list] = OrderedDict()
+        self._call_types: dict[str, list] = {}
+        self._window: deque[tuple[float, int]] = deque()
+        self._window_tokens = 0
+        self.degraded = 0
+        self.rejected = 0
+
+    def record(
+        self,
+        session_id: str | None,
+        call_type: str,
+        usage: dict | None,
+        cost_usd: float | None,
+    ) -> None:
+        input_tokens, output_tokens = _usage_tokens(usage)
+        cost = cost_usd or 0.0
+        totals = self._call_types.setdefault(call_type, [0, 0, 0.0])
+        totals[0] += input_tokens
+        totals[1] += output_tokens
+        totals[2] += cost
+        key = _base_session_id(session_id)
+        if key:
+            session = self._sessions.setdefault(key, [0, 0, 0.0])
+            session[0] += input_tokens
+            session[1] += output_tokens
+            session[2] += cost
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
+        self._window.append((time.monotonic(), input_tokens + output_tokens))
+        self._window_tokens += input_tokens + output_tokens
+
+    def session_tokens(self, session_id: str | None) -> int:
+        session = self._sessions.get(_base_session_id(session_id) or "")
+        return session[0] + session[1] if session else 0
+
+    def global_tokens(self, window_seconds: int) -> int:
+        cutoff = time.monotonic() - window_seconds
+        while self._window and self._window[0][0] < cutoff:
+            self._window_tokens -= self._window.popleft()[1]
+        return self._window_tokens
+
+    def check(self, session_id: str | None, config: RuntimeConfig) -> str:
+        ratio = 0.0
+        if config.session_token_budget > 0 and session_id:
+            ratio = max(ratio, self.session_tokens(session_id) / config.session_token_budget)
+        if config.global_token_budget > 0:
+            used = self.global_tokens(config.token_budget_window_seconds)
+            ratio = max(ratio, used / config.global_token_budget)
+        if ratio >= 1:
+            self.rejected += 1
+            return "exhausted"
+        if ratio >= config.budget_degrade_ratio:
+            self.degraded += 1
+            return "degrade"
+        return "ok"
+
+    def release(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def render(self, window_seconds: int) -> List[str]:
+        lines = [
+            "# HELP recovery_tokens_total Tokens reported by the model per call type.",
+            "# TYPE recovery_tokens_total counter",
+        ]
+        for call_type, (input_tokens, output_tokens, _) in sorted(self._call_types.items()):
+            lines.append(f'recovery_tokens_total{{call_type="{call_type}",direction="input"}} {input_tokens}')
+            lines.append(f'recovery_tokens_total{{call_type="{call_type}",direction="output"}} {output_tokens}')
+        lines += [
+            "# HELP recovery_cost_usd_total Reported model cost per call type.",
+            "# TYPE recovery_cost_usd_total counter",
+        ]
+        for call_type, (_, _, cost) in sorted(self._call_types.items()):
+            lines.append(f'recovery_cost_usd_total{{call_type="{call_type}"}} {cost:.6f}')
+        lines += [
+            "# HELP recovery_budget_window_tokens Tokens used within the global budget window.",
+            "# TYPE recovery_budget_window_tokens gauge",
+            f"recovery_budget_window_tokens {self.global_tokens(window_seconds)}",
+            "# HELP recovery_budget_sessions Sessions with recorded usage.",
+            "# TYPE recovery_budget_sessions gauge",
+            f"recovery_budget_sessions {len(self._sessions)}",
+            "# HELP recovery_budget_degraded_total Calls served with the degraded model settings.",
+            "# TYPE recovery_budget_degraded_total counter",
+            f"recovery_budget_degraded_total {self.degraded}",
+            "# HELP recovery_budget_rejected_total Calls refused because a token budget was spent.",
+            "# TYPE recovery_budget_rejected_total counter",
+            f"recovery_budget_rejected_total {self.rejected}",
+        ]
+        return lines
+
+
+_USAGE = _UsageLedger()
+
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class _Circuit:
+    def __init__(self) -> None:
+        self.state = "closed"
+        self.calls: deque[tuple[float, bool]] = deque()
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+
+
+class _CircuitBreaker:
+    def __init__(self) -> None:
+        self._circuits: dict[str, _Circuit] = {}
+
+    def _open(self, backend: str, circuit: _Circuit, reason: str) -> None:
+        circuit.state = "open"
+        circuit.opened_at = time.monotonic()
+        circuit.probing = False
+        circuit.calls.clear()
+        circuit.opened += 1
+        logger.warning("Circuit for %s opened: %s", backend, reason)
+
+    def acquire(self, backend: str, config: RuntimeConfig) -> str | None:
+        circuit = self._circuits.setdefault(backend, _Circuit())
+        if (
+            circuit.state == "open"
+            and time.monotonic() - circuit.opened_at >= config.breaker_open_seconds
+        ):
+            circuit.state = "half_open"
+            circuit.probing = False
+            logger.info("Circuit for %s half-open; probing backend.", backend)
+        if circuit.state == "closed":
+            return "call"
+        if circuit.state == "half_open" and not circuit.probing:
+            circuit.probing = True
+            return "probe"
+        circuit.rejected += 1
+        return None
+
+    def end_probe(self, backend: str) -> None:
+        circuit = self._circuits.get(backend)
+        if circuit is not None and circuit.state == "half_open":
+            circuit.probing = False
+
+    def record(self, backend: str, failed: bool, config: RuntimeConfig) -> None:
+        circuit = self._circuits.setdefault(backend, _Circuit())
+        if circuit.state == "half_open":
+            if failed:
+                self._open(backend, circuit, "probe failed")
+            else:
+                circuit.state = "closed"
+                circuit.probing = False
+                circuit.calls.clear()
+                logger.info("Circuit for %s closed; backend recovered.", backend)
+            return
+        if circuit.state == "open":
+            return
+        now = time.monotonic()
+        circuit.calls.append((now, failed))
+        cutoff = now - config.breaker_window_seconds
+        while circuit.calls and circuit.calls[0][0] < cutoff:
+            circuit.calls.popleft()
+        failures = sum(1 for _, call_failed in circuit.calls if call_failed)
+        if (
+            len(circuit.calls) >= max(1, config.breaker_min_calls)
+            and failures >= len(circuit.calls) * config.breaker_failure_ratio
+        ):
+            self._open(backend, circuit, f"{failures}/{len(circuit.calls)} calls failed or slow")
+
+    def render(self) -> List[str]:
+        circuits = sorted(self._circuits.items())
+        lines = [
+            "# HELP recovery_circuit_state Circuit state per backend (0 closed, 1 half-open, 2 open).",
+            "# TYPE recovery_circuit_state gauge",
+        ]
+        lines += [
+            f'recovery_circuit_state{{backend="{backend}"}} {CIRCUIT_STATES[circuit.state]}'
+            for backend, circuit in circuits
+        ]
+        lines += [
+            "# HELP recovery_circuit_window_calls Calls in the sliding window per backend.",
+            "# TYPE recovery_circuit_window_calls gauge",
+        ]
+        for backend, circuit in circuits:
+            failures = sum(1 for _, call_failed in circuit.calls if call_failed)
+            lines.append(f'recovery_circuit_window_calls{{backend="{backend}",outcome="failed"}} {failures}')
+            lines.append(
+                f'recovery_circuit_window_calls{{backend="{backend}",outcome="ok"}} '
+                f"{len(circuit.calls) - failures}"
+            )
+        for name, attribute, help_text in (
+            ("recovery_circuit_opened_total", "opened", "Times the circuit opened per backend."),
+            ("recovery_circuit_rejected_total", "rejected", "Calls refused by an open circuit per backend."),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [
+                f'{name}{{backend="{backend}"}} {getattr(circuit, attribute)}'
+                for backend, circuit in circuits
+            ]
+        return lines
+
+
+_BREAKER = _CircuitBreaker()
+
+
+class _RouteStats:
+    def __init__(self, window: int = 512) -> None:
+        self._window = window
+        self._routes: dict[str, dict] = {}
+
+    def record(
+        self,
+        route: str,
+        model: str,
+        status: str,
+        latency: float,
+        ttft: float | None,
+        usage: dict | None,
+    ) -> None:
+        stats = self._routes.setdefault(
+            route,
+            {
+                "calls": 0,
+                "errors": 0,
+                "cancelled": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "latencies": deque(maxlen=self._window),
+                "ttfts": deque(maxlen=self._window),
+            },
+        )
+        stats["calls"] += 1
+        if status == "error":
+            stats["errors"] += 1
+        elif status == "cancelled":
+            stats["cancelled"] += 1
+        stats["latencies"].append(latency)
+        if ttft is not None:
+            stats["ttfts"].append(ttft)
+        input_tokens, output_tokens = _usage_tokens(usage)
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+        logger.info(
+            "Route %s (%s) %s in %.2fs, ttft %s, tokens in/out %d/%d",
+            route,
+            model,
+            status,
+            latency,
+            f"{ttft:.2f}s" if ttft is not None else "-",
+            input_tokens,
+            output_tokens,
         )
 
-    prompt_messages = _strip_images_from_messages(messages) if had_image else messages
-    if had_image:
-        system_prompt = (
-            f"{system_prompt}\n\nNote: Image inputs are omitted; provide text-only guidance."
+    @staticmethod
+    def _percentile(values: Iterable[float], fraction: float) -> float:
+        ordered = sorted(values)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    def ttft_percentile(self, route: str, fraction: float, min_samples: int) -> float | None:
+        stats = self._routes.get(route)
+        if stats is None or len(stats["ttfts"]) < max(1, min_samples):
+            return None
+        return self._percentile(stats["ttfts"], fraction)
+
+    def snapshot(self) -> dict[str, dict]:
+        result = {}
+        for route, stats in self._routes.items():
+            result[route] = {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "cancelled": stats["cancelled"],
+                "input_tokens": stats["input_tokens"],
+                "output_tokens": stats["output_tokens"],
+                "latency_p50": self._percentile(stats["latencies"], 0.5),
+                "latency_p95": self._percentile(stats["latencies"], 0.95),
+                "ttft_p50": self._percentile(stats["ttfts"], 0.5),
+                "ttft_p95": self._percentile(stats["ttfts"], 0.95),
+            }
+        return result
+
+
+_ROUTE_STATS = _RouteStats()
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _StageHistograms:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self._buckets = buckets
+        self._series: dict[tuple[str, str], list] = {}
+
+    def observe(self, stage: str, call_type: str, seconds: float) -> None:
+        series = self._series.setdefault((stage, call_type), [0] * len(self._buckets) + [0.0, 0])
+        index = bisect.bisect_left(self._buckets, seconds)
+        if index < len(self._buckets):
+            series[index] += 1
+        series[-2] += seconds
+        series[-1] += 1
+
+    def render(self, name: str) -> List[str]:
+        lines = [
+            f"# HELP {name} Time spent in each consultation stage.",
+            f"# TYPE {name} histogram",
+        ]
+        for (stage, call_type), series in sorted(self._series.items()):
+            labels = f'stage="{stage}",call_type="{call_type}"'
+            cumulative = 0
+            for bound, count in zip(self._buckets, series):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f"{name}_sum{{{labels}}} {series[-2]:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+_STAGE_METRICS = _StageHistograms(STAGE_BUCKETS)
+
+
+class _Trace:
+    def __init__(self, call_type: str, session_id: str | None = None) -> None:
+        self.trace_id = uuid.uuid4().hex
+        self.call_type = call_type
+        self.session_id = session_id
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans: List[dict] = []
+
+    def record(self, stage: str, start: float, end: float) -> None:
+        _STAGE_METRICS.observe(stage, self.call_type, end - start)
+        self.spans.append(
+            {
+                "stage": stage,
+                "start_ms": round((start - self._started) * 1000, 2),
+                "duration_ms": round((end - start) * 1000, 2),
+            }
         )
-    prompt = _messages_to_prompt(system_prompt, prompt_messages)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter())
+
+    def finish(self, trace_dir: str = "") -> None:
+        self.record("total", self._started, time.perf_counter())
+        if trace_dir:
+            self.dump(trace_dir)
+
+    def dump(self, directory: str) -> None:
+        path = Path(directory)
+        if not path.is_absolute():
+            path = PROJECT_ROOT / path
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+            (path / f"{stamp}-{self.call_type}-{self.trace_id[:12]}.json").write_text(
+                json.dumps(
+                    {
+                        "trace_id": self.trace_id,
+                        "call_type": self.call_type,
+                        "session_id": self.session_id,
+                        "started_at": self.started_at,
+                        "spans": self.spans,
+                    },
+                    ensure_ascii=False,
+                    indent=2,
+                ),
+                encoding="utf-8",
+            )
+        except OSError:
+            logger.exception("Failed to write trace to %s", path)
+
+
+def _render_metrics() -> str:
+    lines = _STAGE_METRICS.render("recovery_stage_duration_seconds")
+    lines += _USAGE.render(_runtime_config().token_budget_window_seconds)
+    lines += _BREAKER.render()
+    routes = _ROUTE_STATS.snapshot()
+    for name, key, kind, help_text in (
+        ("recovery_route_calls_total", "calls", "counter", "Model calls per route."),
+        ("recovery_route_errors_total", "errors", "counter", "Failed model calls per route."),
+        ("recovery_route_cancelled_total", "cancelled", "counter", "Cancelled model calls per route."),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{route="{route}"}} {stats[key]}' for route, stats in sorted(routes.items())]
+    name = "recovery_route_tokens_total"
+    lines += [f"# HELP {name} Tokens reported by the model per route.", f"# TYPE {name} counter"]
+    for route, stats in sorted(routes.items()):
+        lines.append(f'{name}{{route="{route}",direction="input"}} {stats["input_tokens"]}')
+        lines.append(f'{name}{{route="{route}",direction="output"}} {stats["output_tokens"]}')
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics_endpoint(request: Request) -> PlainTextResponse:
+    if not _runtime_config().metrics_endpoint:
+        return PlainTextResponse("Not Found", status_code=404)
+    return PlainTextResponse(_render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+METRICS_ROUTES = [Route("/metrics", _metrics_endpoint)]
+
+
+async def _stream_agent_text(
+    segments: tuple[str, str, str],
+    image_payloads: List[dict],
+    options: ClaudeAgentOptions,
+    session_id: str | None,
+    config: RuntimeConfig,
+    route: str = "plan",
+    trace: _Trace | None = None,
+) -> AsyncIterator[str]:
+    trace = trace or _Trace(route)
+    agent_prompt: str | AsyncIterator[dict] = _prompt_text(segments)
+    if image_payloads or config.prompt_cache_markers:
+        agent_prompt = _user_message_stream(
+            _prompt_content(segments, config.prompt_cache_markers) + image_payloads
+        )
+
+    started = time.perf_counter()
+    first_event: float | None = None
+    first_token: float | None = None
+    usage: dict | None = None
+    cost_usd: float | None = None
+    result_error = False
+    status = "error"
+    committed = ""
+    partial = ""
+    try:
+        async for event in _agent_events(agent_prompt, options, session_id, config, trace):
+            if first_event is None:
+                first_event = time.perf_counter()
+                trace.record("first_event", started, first_event)
+            if isinstance(event, ResultMessage):
+                usage = event.usage
+                cost_usd = event.total_cost_usd
+                result_error = event.is_error
+                continue
+            if isinstance(event, StreamEvent):
+                delta = _stream_event_text(event)
+                if delta:
+                    first_token = first_token or time.perf_counter()
+                    partial += delta
+                    yield (committed + partial).strip()
+                continue
+            text = _event_text(event)
+            partial = ""
+            if text:
+                first_token = first_token or time.perf_counter()
+                committed += text
+                yield committed.strip()
+        status = "error" if result_error else "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "cancelled"
+        raise
+    finally:
+        finished = time.perf_counter()
+        if first_token is not None:
+            trace.record("first_token", started, first_token)
+            trace.record("generation", first_token, finished)
+        _ROUTE_STATS.record(
+            route,
+            options.model or "",
+            status,
+            finished - started,
+            (first_token - started) if first_token else None,
+            usage,
+        )
+        _USAGE.record(trace.session_id, trace.call_type, usage, cost_usd)
+        if config.circuit_breaker:
+            waited = (first_token or finished) - started
+            slow = 0 < config.breaker_slow_call_seconds <= waited
+            if status != "cancelled" or slow:
+                _BREAKER.record(
+                    _backend_label(options.model, options.env.get("ANTHROPIC_BASE_URL")),
+                    status == "error" or slow,
+                    config,
+                )
+
+    output = committed.strip()
+    if not output:
+        yield NO_REPLY_TEXT
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.latest = ""
+        self.version = 0
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task: asyncio.Task | None = None
+
+    async def publish(self, value: str) -> None:
+        async with self.changed:
+            self.latest = value
+            self.version += 1
+            self.changed.notify_all()
+
+    async def finish(self, error: BaseException | None) -> None:
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+
+class _SingleFlight:
+    def __init__(self) -> None:
+        self._flights: dict[str, _Flight] = {}
+
+    async def _drive(
+        self,
+        key: str,
+        flight: _Flight,
+        source: Callable[[], AsyncIterator[str]],
+        timeout_seconds: int,
+    ) -> None:
+        error: BaseException | None = None
+
+        async def _pump() -> None:
+            async for value in source():
+                await flight.publish(value)
+
+        try:
+            await asyncio.wait_for(_pump(), timeout_seconds or None)
+        except asyncio.TimeoutError:
+            logger.warning("Model call timed out after %ss", timeout_seconds)
+            latest = flight.latest
+            await flight.publish(f"{latest}\n\n{TIMEOUT_TEXT}" if latest else TIMEOUT_TEXT)
+        except asyncio.CancelledError as exc:
+            error = exc
+        except Exception as exc:
+            error = exc
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            await flight.finish(error)
+
+    async def run(
+        self,
+        key: str,
+        source: Callable[[], AsyncIterator[str]],
+        timeout_seconds: int = 0,
+    ) -> AsyncIterator[str]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(
+                self._drive(key, flight, source, timeout_seconds)
+            )
+        flight.subscribers += 1
+        seen = 0
+        try:
+            while True:
+                async with flight.changed:
+                    await flight.changed.wait_for(
+                        lambda: flight.version > seen or flight.done
+                    )
+                    version, value = flight.version, flight.latest
+                    done, error = flight.done, flight.error
+                if version > seen:
+                    seen = version
+                    yield value
+                    continue
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done and flight.task is not None:
+                flight.task.cancel()
+
+
+_SINGLE_FLIGHT = _SingleFlight()
+
+
+def _flight_key(prompt: str, image_payloads: List[dict], options: ClaudeAgentOptions) -> str:
+    digest = hashlib.sha256()
+    digest.update(_options_fingerprint(options).encode("utf-8"))
+    digest.update(prompt.encode("utf-8"))
+    for payload in image_payloads:
+        digest.update(str(payload.get("source", {}).get("data", "")).encode("ascii"))
+    return digest.hexdigest()
+
+
+class _Ticket:
+    def __init__(self, session_id: str, priority: int, seq: int) -> None:
+        self.session_id = session_id
+        self.sort_key = (priority, seq)
+        self.admitted = False
+        self.wake = asyncio.Event()
+
+
+class _AdmissionController:
+    def __init__(self) -> None:
+        self._active = 0
+        self._active_by_session: dict[str, int] = {}
+        self._waiting: list[_Ticket] = []
+        self._seq = itertools.count()
+        self._max_concurrent = DEFAULT_CONFIG["max_concurrent_requests"]
+        self._max_per_session = DEFAULT_CONFIG["max_requests_per_session"]
+
+    @staticmethod
+    def _ticket_session(session_id: str | None) -> str:
+        if _is_section_session(session_id):
+            return ""
+        return _base_session_id(session_id) or ""
+
+    def _session_has_room(self, session_id: str) -> bool:
+        if not session_id or self._max_per_session <= 0:
+            return True
+        return self._active_by_session.get(session_id, 0) < self._max_per_session
+
+    def _admit(self, ticket: _Ticket) -> None:
+        ticket.admitted = True
+        self._active += 1
+        if ticket.session_id:
+            self._active_by_session[ticket.session_id] = (
+                self._active_by_session.get(ticket.session_id, 0) + 1
+            )
+
+    def _dispatch(self) -> None:
+        for ticket in list(self._waiting):
+            if self._max_concurrent > 0 and self._active >= self._max_concurrent:
+                break
+            if not self._session_has_room(ticket.session_id):
+                continue
+            self._waiting.remove(ticket)
+            self._admit(ticket)
+            ticket.wake.set()
+        for ticket in self._waiting:
+            ticket.wake.set()
+
+    def enqueue(self, session_id: str | None, priority: int, config: RuntimeConfig) -> _Ticket | None:
+        self._max_concurrent = config.max_concurrent_requests
+        self._max_per_session = config.max_requests_per_session
+        ticket = _Ticket(self._ticket_session(session_id), priority, next(self._seq))
+        immediate = self._session_has_room(ticket.session_id) and (
+            self._max_concurrent <= 0 or self._active < self._max_concurrent
+        )
+        if not immediate and 0 <= config.max_queue_size <= len(self._waiting):
+            return None
+        keys = [waiting.sort_key for waiting in self._waiting]
+        self._waiting.insert(bisect.bisect(keys, ticket.sort_key), ticket)
+        self._dispatch()
+        return ticket
+
+    def has_waiting(self) -> bool:
+        return bool(self._waiting)
+
+    def try_admit(self, session_id: str | None, priority: int, config: RuntimeConfig) -> _Ticket | None:
+        self._max_concurrent = config.max_concurrent_requests
+        self._max_per_session = config.max_requests_per_session
+        ticket = _Ticket(self._ticket_session(session_id), priority, next(self._seq))
+        if self._waiting or not self._session_has_room(ticket.session_id):
+            return None
+        if self._max_concurrent > 0 and self._active >= self._max_concurrent:
+            return None
+        self._admit(ticket)
+        return ticket
+
+    def position(self, ticket: _Ticket) -> int:
+        return self._waiting.index(ticket) + 1 if ticket in self._waiting else 0
+
+    async def wait(self, ticket: _Ticket) -> AsyncIterator[int]:
+        last_position = 0
+        while True:
+            ticket.wake.clear()
+            if ticket.admitted:
+                return
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield position
+                if ticket.admitted:
+                    return
+            await ticket.wake.wait()
+
+    def release(self, ticket: _Ticket) -> None:
+        if ticket.admitted:
+            ticket.admitted = False
+            self._active -= 1
+            if ticket.session_id:
+                remaining = self._active_by_session.get(ticket.session_id, 1) - 1
+                if remaining > 0:
+                    self._active_by_session[ticket.session_id] = remaining
+                else:
+                    self._active_by_session.pop(ticket.session_id, None)
+        elif ticket in self._waiting:
+            self._waiting.remove(ticket)
+        self._dispatch()
+
+
+_ADMISSION = _AdmissionController()
+
+
+async def _admitted(
+    source: Callable[[], AsyncIterator[str]],
+    session_id: str | None,
+    call_type: str,
+    config: RuntimeConfig,
+    trace: "_Trace | None" = None,
+) -> AsyncIterator[str]:
+    ticket = _ADMISSION.enqueue(session_id, CALL_PRIORITIES.get(call_type, 1), config)
+    if ticket is None:
+        yield BUSY_TEXT
+        return
+    try:
+        waited = time.perf_counter()
+        async for position in _ADMISSION.wait(ticket):
+            yield f"排队中，当前第 {position} 位，请稍候…"
+        if trace is not None:
+            trace.record("queue_wait", waited, time.perf_counter())
+        async for value in source():
+            yield value
+    finally:
+        _ADMISSION.release(ticket)
+
+
+_HEDGE_DONE = object()
+
+
+async def _hedged(
+    primary: Callable[[], AsyncIterator[str]],
+    hedge: Callable[[], AsyncIterator[str]],
+    delay: float,
+) -> AsyncIterator[str]:
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def _pump(index: int, source: Callable[[], AsyncIterator[str]]) -> None:
+        try:
+            async for value in source():
+                results.put_nowait((index, value, None))
+        except Exception as exc:
+            results.put_nowait((index, _HEDGE_DONE, exc))
+            return
+        results.put_nowait((index, _HEDGE_DONE, None))
+
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.create_task(_pump(0, primary))]
+    hedge_at = loop.time() + delay
+    winner: int | None = None
+    ended = 0
+    error: Exception | None = None
+    getter: asyncio.Task | None = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(results.get())
+            if winner is None and len(tasks) == 1:
+                done, _ = await asyncio.wait({getter}, timeout=max(0.0, hedge_at - loop.time()))
+                if not done:
+                    logger.info("No output after %.1fs; starting hedged request.", delay)
+                    tasks.append(asyncio.create_task(_pump(1, hedge)))
+                    continue
+            index, value, failure = await getter
+            getter = None
+            if winner is not None and index != winner:
+                continue
+            if value is _HEDGE_DONE:
+                if winner is not None:
+                    if failure is not None:
+                        raise failure
+                    return
+                ended += 1
+                error = failure or error
+                if len(tasks) == 1:
+                    tasks.append(asyncio.create_task(_pump(1, hedge)))
+                elif ended == len(tasks):
+                    if error is not None:
+                        raise error
+                    return
+                continue
+            if winner is None:
+                winner = index
+                for other, task in enumerate(tasks):
+                    if other != winner:
+                        task.cancel()
+                if winner == 1:
+                    logger.info("Hedged request answered first.")
+            yield value
+    finally:
+        if getter is not None:
+            getter.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def _run_agent(
+    prefix: str,
+    history_lines: List[str],
+    user_message: str,
+    image: ImageAttachment | None = None,
+    session_id: str | None = None,
+    config: RuntimeConfig | None = None,
+    call_type: str = "interview",
+    backend: "BackendConfig | None" = None,
+    trace: _Trace | None = None,
+    served: List[str] | None = None,
+) -> AsyncIterator[str]:
+    config = config or _runtime_config()
+    trace = trace or _Trace(call_type, session_id)
+    route = _route_name(call_type)
+    backend = backend or BackendConfig.from_runtime(config, route)
+    served_by = "primary"
+    budget = _USAGE.check(session_id, config)
+    if budget == "exhausted":
+        logger.warning("Token budget exhausted for session %s", session_id)
+        yield BUDGET_TEXT
+        return
+    if budget == "degrade":
+        degraded = replace(
+            backend,
+            model=config.degraded_model or backend.model,
+            max_tokens=min(backend.max_tokens, config.degraded_max_tokens)
+            if config.degraded_max_tokens > 0
+            else backend.max_tokens,
+        )
+        if degraded != backend:
+            backend, served_by = degraded, "degraded"
+    permit = "call"
+    if config.circuit_breaker:
+        permit = _BREAKER.acquire(backend.label, config)
+        fallback = backend.fallback(config) if permit is None else None
+        if fallback is not None:
+            permit = _BREAKER.acquire(fallback.label, config)
+            if permit is not None:
+                logger.warning("Circuit for %s open; using %s", backend.label, fallback.label)
+                backend, served_by = fallback, "fallback"
+        if permit is None:
+            yield UNAVAILABLE_TEXT
+            return
+    if served is not None:
+        served.append(served_by)
+    agent_session = None if _is_section_session(session_id) else session_id
+    if agent_session and backend != BackendConfig.from_runtime(config):
+        agent_session = f"{agent_session}:{route}"
+
+    image_payloads: List[dict] = []
+    if image and config.send_images:
+        try:
+            with trace.span("image_encode"):
+                image_payloads = [
+                    await asyncio.to_thread(
+                        image.to_payload,
+                        config.image_max_side,
+                        config.image_quality,
+                    )
+                ]
+        except Exception:
+            logger.exception("Image processing failed; continuing without image.")
+    if image and not image_payloads:
+        user_message = (
+            f"{user_message}\n\nNote: Image inputs are omitted; provide text-only guidance."
+        )
+    with trace.span("prompt_render"):
+        segments = _render_prompt(prefix, history_lines, user_message)
+        prompt_text = _prompt_text(segments)
 
     options = ClaudeAgentOptions(
         cwd=str(PROJECT_ROOT),
         setting_sources=["project", "user"],
         allowed_tools=["Skill"],
+        include_partial_messages=True,
+        model=backend.model or None,
+        env=backend.env(),
     )
 
-    chunks: list[str] = []
-    async for event in query(prompt=prompt, options=options):
-        if isinstance(event, str):
-            chunks.append(event)
-            continue
-        content = getattr(event, "content", None)
-        if isinstance(content, str):
-            chunks.append(content)
-            continue
-        if isinstance(content, list):
-            parts = []
-            for block in content:
-                if isinstance(block, dict):
-                    text_part = block.get("text")
-                else:
-                    text_part = getattr(block, "text", None)
-                if isinstance(text_part, str):
-                    parts.append(text_part)
-            if parts:
-                chunks.append("".join(parts))
-            continue
-        text_part = getattr(event, "text", None)
-        if isinstance(text_part, str):
-            chunks.append(text_part)
+    def _primary() -> AsyncIterator[str]:
+        return _stream_agent_text(
+            segments, image_payloads, options, agent_session, config, route, trace
+        )
 
-    output = "".join(chunks).strip()
-    return output or "未收到模型回复。"
+    async def _hedge() -> AsyncIterator[str]:
+        ticket = _ADMISSION.try_admit(session_id, CALL_PRIORITIES.get(call_type, 1), config)
+        if ticket is None:
+            logger.info("No free slot for a hedged request; waiting on the primary.")
+            return
+        try:
+            async for value in _stream_agent_text(
+                segments, image_payloads, options, None, config, route, _Trace(call_type, session_id)
+            ):
+                yield value
+        finally:
+            _ADMISSION.release(ticket)
+
+    def _attempt() -> AsyncIterator[str]:
+        if not config.hedge_requests or _ADMISSION.has_waiting():
+            return _primary()
+        delay = _ROUTE_STATS.ttft_percentile(route, 0.95, config.hedge_min_samples)
+        return _hedged(
+            _primary,
+            _hedge,
+            delay if delay is not None else config.hedge_delay_seconds,
+        )
+
+    flight_key = _flight_key(prompt_text, image_payloads, options)
+    try:
+        async for partial in _SINGLE_FLIGHT.run(
+            flight_key,
+            lambda: _admitted(
+                _attempt,
+                session_id,
+                call_type,
+                config,
+                trace,
+            ),
+            timeout_seconds=config.routes[route].timeout_seconds or config.request_timeout_seconds,
+        ):
+            yield partial
+    finally:
+        if permit == "probe":
+            _BREAKER.end_probe(backend.label)
 
 
 
@@ -615,42 +2734,474 @@ async def respond(
     prior_injury: str,
     treatment_done: str,
     notes: str,
-) -> str:
-    if not _get_api_key():
-        return "缺少 API Key。请设置 ANTHROPIC_API_KEY 或在 config.local.yaml 中填写 api_key。"
-
-    normalized_history = _normalize_history(history or [])
-    intake = _build_intake(
-        sport,
-        injury_region,
-        injury_type,
-        onset_type,
-        time_since,
-        pain_score,
-        symptoms or [],
-        injury_image or "",
-        training_goal,
-        training_phase,
-        prior_injury,
-        treatment_done,
-        notes,
+    session_id: str | None = None,
+    call_type: str = "interview",
+    served: List[str] | None = None,
+) -> AsyncIterator[str]:
+    trace = _Trace(call_type, session_id)
+    with trace.span("config"):
+        config = _runtime_config()
+    if not config.api_key:
+        yield "缺少 API Key。请设置 ANTHROPIC_API_KEY 或在 config.local.yaml 中填写 api_key。"
+        return
+
+    with trace.span("retrieval"):
+        references = await asyncio.to_thread(
+            _KNOWLEDGE.references,
+            _retrieval_query(injury_region, injury_type),
+            config,
+        )
+    with trace.span("image_load"):
+        image, image_note = _build_image_payload(injury_image, config.max_image_bytes)
+    history_span = time.perf_counter()
+    conversation = _session_conversation(session_id)
+    conversation.sync(history or [])
+    prefix = conversation.prefix(
+        SYSTEM_PROMPT,
+        (
+            sport,
+            injury_region,
+            injury_type,
+            onset_type,
+            time_since,
+            pain_score,
+            tuple(symptoms or []),
+            injury_image or "",
+            training_goal,
+            training_phase,
+            prior_injury,
+            treatment_done,
+            notes,
+        ),
+        references,
     )
-    config = _runtime_config()
-    image_payload, image_note = _build_image_payload(
-        injury_image,
-        _parse_int(config.get("max_image_bytes"), DEFAULT_CONFIG["max_image_bytes"]),
+    history_lines = conversation.history_lines(
+        config.history_token_budget,
+        config.summary_token_budget,
     )
-    user_message = f"""运动员基本信息:
-{intake}
-
-用户诉求:
-{message}
-"""
+    trace.record("history", history_span, time.perf_counter())
+    user_message = f"用户诉求:\n{message}"
     if image_note:
         user_message = f"{user_message}\n\n图片提示: {image_note}"
-    system_prompt = SYSTEM_PROMPT
-    messages = _build_messages(normalized_history, user_message, image_payload)
-    return await _run_agent(system_prompt, messages, had_image=bool(image_payload))
+    try:
+        async for partial in _run_agent(
+            prefix,
+            history_lines,
+            user_message,
+            image=image,
+            session_id=session_id,
+            config=config,
+            call_type=call_type,
+            trace=trace,
+            served=served,
+        ):
+            yield partial
+    finally:
+        trace.finish(config.trace_dir)
+
+
+class _MemoryPlanCache:
+    def __init__(self, ttl_seconds: int, max_entries: int) -> None:
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.time() - stored_at > self._ttl_seconds:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+class _SQLitePlanCache:
+    def __init__(self, path: Path, ttl_seconds: int, max_entries: int) -> None:
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS plan_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT value, stored_at FROM plan_cache WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self._ttl_seconds:
+            self._conn.execute("DELETE FROM plan_cache WHERE key = ?", (key,))
+            return None
+        self._conn.execute("UPDATE plan_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO plan_cache (key, value, stored_at, accessed_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        self._conn.execute(
+            "DELETE FROM plan_cache WHERE stored_at < ? OR key NOT IN "
+            "(SELECT key FROM plan_cache ORDER BY accessed_at DESC LIMIT ?)",
+            (now - self._ttl_seconds, self._max_entries),
+        )
+
+
+_PLAN_CACHES: dict[tuple, object] = {}
+
+
+def _get_plan_cache(config: RuntimeConfig) -> "_MemoryPlanCache | _SQLitePlanCache | None":
+    backend = config.plan_cache_backend
+    if backend not in ("memory", "sqlite") or config.plan_cache_max_entries <= 0:
+        return None
+    cache_key = (
+        backend,
+        config.plan_cache_path,
+        config.plan_cache_ttl_seconds,
+        config.plan_cache_max_entries,
+    )
+    cache = _PLAN_CACHES.get(cache_key)
+    if cache is None:
+        if backend == "sqlite":
+            path = Path(config.plan_cache_path)
+            if not path.is_absolute():
+                path = PROJECT_ROOT / path
+            cache = _SQLitePlanCache(
+                path,
+                config.plan_cache_ttl_seconds,
+                config.plan_cache_max_entries,
+            )
+        else:
+            cache = _MemoryPlanCache(
+                config.plan_cache_ttl_seconds,
+                config.plan_cache_max_entries,
+            )
+        _PLAN_CACHES[cache_key] = cache
+    return cache
+
+
+def _plan_cache_key(
+    plan_request: str,
+    history: List,
+    intake_values: List,
+    config: RuntimeConfig,
+    call_type: str = "plan",
+) -> str:
+    backend = BackendConfig.from_runtime(config, _route_name(call_type))
+    normalized_values = [
+        sorted(value) if isinstance(value, (list, tuple)) else value
+        for value in intake_values
+    ]
+    normalized_values = [
+        value.strip() if isinstance(value, str) else value for value in normalized_values
+    ]
+    normalized_history = [
+        [str(user_text or "").strip(), str(assistant_text or "").strip()]
+        for user_text, assistant_text in _normalize_history(history or [])
+    ]
+    canonical = json.dumps(
+        {
+            "request": plan_request,
+            "intake": normalized_values,
+            "history": normalized_history,
+            "system_prompt": SYSTEM_PROMPT,
+            "base_url": backend.base_url,
+            "model": backend.model,
+            "max_tokens": backend.max_tokens,
+            "send_images": config.send_images,
+            "parallel_plan_sections": config.parallel_plan_sections,
+            "use_plan_templates": config.use_plan_templates,
+            "plan_templates_version": _plan_templates_version(config),
+            "knowledge_index": _KNOWLEDGE.version(config),
+            "retrieval": [
+                config.retrieval_top_k,
+                config.retrieval_budget_ms,
+                config.retrieval_max_chars,
+            ],
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _served_by_primary(served: List[str]) -> bool:
+    return bool(served) and all(kind == "primary" for kind in served)
+
+
+def _is_complete_reply(text: str) -> bool:
+    return bool(text) and not text.endswith(
+        (
+            NO_REPLY_TEXT,
+            BUSY_TEXT,
+            BUDGET_TEXT,
+            UNAVAILABLE_TEXT,
+            TIMEOUT_TEXT,
+            INCOMPLETE_PLAN_TEXT,
+        )
+    )
+
+
+def _section_request(title: str, instruction: str) -> str:
+    return (
+        f"{PLAN_REQUEST}\n\n本次只输出其中的「{title}」部分：{instruction}。"
+        f"以二级标题“## {title}”开头，不要输出其他部分。"
+    )
+
+
+async def _plan_sections_stream(
+    history: List,
+    intake_values: List,
+    session_id: str | None,
+    call_type: str,
+    served: List[str] | None = None,
+) -> AsyncIterator[str]:
+    texts = [""] * len(PLAN_SECTIONS)
+    done = [False] * len(PLAN_SECTIONS)
+    changed = asyncio.Event()
+
+    async def _generate(index: int, title: str, instruction: str) -> None:
+        try:
+            async for partial in respond(
+                _section_request(title, instruction),
+                history,
+                *intake_values,
+                session_id=f"{session_id}{SECTION_SESSION_MARK}{index}" if session_id else None,
+                call_type=call_type,
+                served=served,
+            ):
+                texts[index] = partial
+                changed.set()
+        finally:
+            done[index] = True
+            changed.set()
+
+    tasks = [
+        asyncio.create_task(_generate(index, title, instruction))
+        for index, (title, instruction) in enumerate(PLAN_SECTIONS)
+    ]
+    try:
+        last = ""
+        while True:
+            await changed.wait()
+            changed.clear()
+            visible = []
+            for index in range(len(PLAN_SECTIONS)):
+                if texts[index]:
+                    visible.append(texts[index])
+                if not done[index]:
+                    break
+            merged = "\n\n".join(visible)
+            if merged and merged != last:
+                last = merged
+                yield merged
+            if all(done):
+                break
+        for task in tasks:
+            if task.exception() is not None:
+                raise task.exception()
+        if not all(_is_complete_reply(text) for text in texts):
+            yield f"{last}\n\n{INCOMPLETE_PLAN_TEXT}" if last else INCOMPLETE_PLAN_TEXT
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _intake_triage_text(intake_values: List) -> str:
+    _, injury_region, _, onset_type, _, pain_score, symptoms, *_ = intake_values
+    return _render_triage(_triage(symptoms, pain_score, onset_type, injury_region))
+
+
+async def _with_triage(
+    source: AsyncIterator[str],
+    triage_text: str,
+    config: RuntimeConfig,
+) -> AsyncIterator[str]:
+    if not triage_text:
+        async for partial in source:
+            yield partial
+        return
+    yield triage_text
+    if not config.triage_continue:
+        await source.aclose()
+        return
+    async for partial in source:
+        yield f"{triage_text}{TRIAGE_SEPARATOR}{partial}"
+
+
+_PLAN_TEMPLATE_STORES: dict[str, tuple[tuple, PlanTemplateStore]] = {}
+
+
+def _plan_templates_file(config: RuntimeConfig) -> Path:
+    path = Path(config.plan_templates_path)
+    return path if path.is_absolute() else PROJECT_ROOT / path
+
+
+def _get_plan_templates(config: RuntimeConfig) -> PlanTemplateStore | None:
+    if not config.use_plan_templates:
+        return None
+    path = _plan_templates_file(config)
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _PLAN_TEMPLATE_STORES.get(str(path))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        store = PlanTemplateStore(path)
+    except sqlite3.Error:
+        logger.exception("Failed to open plan templates %s", path)
+        return None
+    _PLAN_TEMPLATE_STORES[str(path)] = (stamp, store)
+    return store
+
+
+def _plan_templates_version(config: RuntimeConfig) -> str:
+    if _get_plan_templates(config) is None:
+        return ""
+    stamp, _ = _PLAN_TEMPLATE_STORES[str(_plan_templates_file(config))]
+    return f"{stamp[0]}:{stamp[1]}"
+
+
+def _nearest_plan_template(intake_values: List, config: RuntimeConfig) -> PlanTemplate | None:
+    store = _get_plan_templates(config)
+    if store is None:
+        return None
+    _, injury_region, injury_type, onset_type = intake_values[:4]
+    return store.nearest(injury_region, injury_type, onset_type, intake_values[9])
+
+
+async def _template_plan_stream(
+    template: PlanTemplate,
+    history: List,
+    intake_values: List,
+    session_id: str | None,
+    call_type: str,
+    served: List[str] | None = None,
+) -> AsyncIterator[str]:
+    base = f"## 基础方案（{template.label}）\n\n{template.plan.strip()}"
+    yield base
+    async for partial in respond(
+        PLAN_DELTA_REQUEST.format(label=template.label, plan=template.plan.strip()),
+        history,
+        *intake_values,
+        session_id=session_id,
+        call_type=call_type,
+        served=served,
+    ):
+        yield f"{base}\n\n{partial}"
+
+
+async def _plan_stream(
+    history: List,
+    intake_values: List,
+    session_id: str | None,
+    call_type: str,
+    config: RuntimeConfig,
+    served: List[str] | None = None,
+) -> AsyncIterator[str]:
+    template = _nearest_plan_template(intake_values, config)
+    if template is not None:
+        source = _template_plan_stream(
+            template, history, intake_values, session_id, call_type, served
+        )
+    elif config.parallel_plan_sections:
+        source = _plan_sections_stream(history, intake_values, session_id, call_type, served)
+    else:
+        source = respond(
+            PLAN_REQUEST,
+            history,
+            *intake_values,
+            session_id=session_id,
+            call_type=call_type,
+            served=served,
+        )
+    async for partial in _with_triage(source, _intake_triage_text(intake_values), config):
+        yield partial
+
+
+class _PlanSpeculator:
+    def __init__(self) -> None:
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._results: dict[str, tuple[str, str]] = {}
+
+    def cancel(self, session_id: str) -> None:
+        task = self._tasks.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+        self._results.pop(session_id, None)
+
+    def schedule(self, session_id: str, history: List, intake_values: List) -> None:
+        self.cancel(session_id)
+        config = _runtime_config()
+        if not config.speculative_plan or not config.api_key:
+            return
+        cache_key = _plan_cache_key(PLAN_REQUEST, history, intake_values, config)
+        self._tasks[session_id] = asyncio.create_task(
+            self._run(session_id, cache_key, list(history), list(intake_values), config)
+        )
+
+    async def _run(
+        self,
+        session_id: str,
+        cache_key: str,
+        history: List,
+        intake_values: List,
+        config: RuntimeConfig,
+    ) -> None:
+        plan = ""
+        served: List[str] = []
+        try:
+            async for partial in _plan_stream(
+                history,
+                intake_values,
+                f"{session_id}:speculative",
+                "speculative",
+                config,
+                served,
+            ):
+                plan = partial
+        except Exception:
+            logger.exception("Speculative plan generation failed.")
+            return
+        finally:
+            if self._tasks.get(session_id) is asyncio.current_task():
+                del self._tasks[session_id]
+        if not _is_complete_reply(plan) or not _served_by_primary(served):
+            return
+        self._results[session_id] = (cache_key, plan)
+        plan_cache = _get_plan_cache(config)
+        if plan_cache is not None:
+            plan_cache.set(cache_key, plan)
+
+    def result(self, session_id: str | None, cache_key: str) -> str | None:
+        stored = self._results.get(session_id or "")
+        if stored is not None and stored[0] == cache_key:
+            return stored[1]
+        return None
+
+
+_SPECULATOR = _PlanSpeculator()
 
 
 def build_app() -> gr.Blocks:
@@ -745,13 +3296,22 @@ def build_app() -> gr.Blocks:
             prior_injury: str,
             treatment_done: str,
             notes: str,
+            request: gr.Request = None,
         ):
             if not message.strip():
-                return history, history, ""
+                yield history, history, ""
+                return
             interview_note = (
                 "继续问诊，只提出 1 个追问问题，不要给出方案。"
             )
-            response = await respond(
+            updated = (history or []) + [
+                {"role": "user", "content": message},
+                {"role": "assistant", "content": ""},
+            ]
+            if request and request.session_hash:
+                _SPECULATOR.cancel(request.session_hash)
+            yield updated, history, ""
+            async for partial in respond(
                 f"{interview_note}\n\nUser answer: {message}",
                 history,
                 sport,
@@ -767,12 +3327,31 @@ def build_app() -> gr.Blocks:
                 prior_injury,
                 treatment_done,
                 notes,
-            )
-            updated = (history or []) + [
-                {"role": "user", "content": message},
-                {"role": "assistant", "content": response},
-            ]
-            return updated, updated, ""
+                session_id=request.session_hash if request else None,
+            ):
+                updated[-1] = {"role": "assistant", "content": partial}
+                yield updated, history, ""
+            yield updated, updated, ""
+            if request and request.session_hash:
+                _SPECULATOR.schedule(
+                    request.session_hash,
+                    updated,
+                    [
+                        sport,
+                        injury_region,
+                        injury_type,
+                        onset_type,
+                        time_since,
+                        pain_score,
+                        symptoms or [],
+                        injury_image or "",
+                        training_goal,
+                        training_phase,
+                        prior_injury,
+                        treatment_done,
+                        notes,
+                    ],
+                )
 
         async def _enter_step2(
             sport: str,
@@ -788,6 +3367,7 @@ def build_app() -> gr.Blocks:
             prior_injury: str,
             treatment_done: str,
             notes: str,
+            request: gr.Request = None,
         ):
             missing = _missing_required_fields(
                 sport,
@@ -799,7 +3379,7 @@ def build_app() -> gr.Blocks:
             )
             if missing:
                 note = "请完成必填项：" + "、".join(missing)
-                return (
+                yield (
                     gr.update(visible=True),
                     gr.update(visible=False),
                     gr.update(visible=False),
@@ -809,11 +3389,26 @@ def build_app() -> gr.Blocks:
                     [],
                     "",
                 )
+                return
             interview_prompt = (
                 "你将开始问诊。基于已提供的信息，提出1个高价值追问问题，"
                 "只输出一个问题，不要给出诊疗方案。"
             )
-            response = await respond(
+            initial_history = [{"role": "assistant", "content": ""}]
+            yield (
+                gr.update(visible=False),
+                gr.update(visible=True),
+                gr.update(visible=False),
+                gr.update(interactive=True),
+                gr.update(value="", visible=False),
+                initial_history,
+                [],
+                "",
+            )
+            triage_text = _render_triage(
+                _triage(symptoms, pain_score, onset_type, injury_region)
+            )
+            interview = respond(
                 interview_prompt,
                 [],
                 sport,
@@ -829,17 +3424,29 @@ def build_app() -> gr.Blocks:
                 prior_injury,
                 treatment_done,
                 notes,
+                session_id=request.session_hash if request else None,
             )
-            initial_history = [{"role": "assistant", "content": response}]
-            return (
-                gr.update(visible=False),
-                gr.update(visible=True),
-                gr.update(visible=False),
-                gr.update(interactive=True),
-                gr.update(value="", visible=False),
+            async for partial in _with_triage(interview, triage_text, _runtime_config()):
+                initial_history = [{"role": "assistant", "content": partial}]
+                yield (
+                    gr.update(),
+                    gr.update(),
+                    gr.update(),
+                    gr.update(),
+                    gr.update(),
+                    initial_history,
+                    [],
+                    gr.update(),
+                )
+            yield (
+                gr.update(),
+                gr.update(),
+                gr.update(),
+                gr.update(),
+                gr.update(),
                 initial_history,
                 initial_history,
-                "",
+                gr.update(),
             )
 
         async def _generate_plan(
@@ -857,37 +3464,65 @@ def build_app() -> gr.Blocks:
             prior_injury: str,
             treatment_done: str,
             notes: str,
+            force_fresh: bool = False,
+            request: gr.Request = None,
         ):
             if not history:
-                return "暂无问诊记录，请返回第 2 步先完成问诊。"
+                yield "暂无问诊记录，请返回第 2 步先完成问诊。"
+                return
             has_user_reply = any(
                 item.get("role") == "user" and str(item.get("content", "")).strip()
                 for item in history
             )
             if not has_user_reply:
-                return "暂无问诊回答，请返回第 2 步先完成追问。"
-            plan_request = (
-                "基于问诊信息生成最终的阶段化康复计划与临床建议，"
-                "包含进阶标准、回归运动清单与清晰的风险红旗。"
-                "如存在红旗症状，先给出紧急就医提示。"
-            )
-            return await respond(
-                plan_request,
-                history,
+                yield "暂无问诊回答，请返回第 2 步先完成追问。"
+                return
+            intake_values = [
                 sport,
                 injury_region,
                 injury_type,
                 onset_type,
                 time_since,
                 pain_score,
-                symptoms,
-                injury_image,
+                symptoms or [],
+                injury_image or "",
                 training_goal,
                 training_phase,
                 prior_injury,
                 treatment_done,
                 notes,
-            )
+            ]
+            config = _runtime_config()
+            plan_cache = _get_plan_cache(config) if config.api_key else None
+            session_id = request.session_hash if request else None
+            cache_key = _plan_cache_key(PLAN_REQUEST, history, intake_values, config)
+            if not force_fresh:
+                cached_plan = _SPECULATOR.result(session_id, cache_key)
+                if cached_plan is None and plan_cache is not None:
+                    cached_plan = plan_cache.get(cache_key)
+                if cached_plan:
+                    yield cached_plan
+                    return
+            yield "正在生成方案，请稍候…"
+            plan = ""
+            served: List[str] = []
+            async for partial in _plan_stream(
+                history,
+                intake_values,
+                session_id,
+                "regenerate" if force_fresh else "plan",
+                config,
+                served,
+            ):
+                plan = partial
+                yield partial
+            if (
+                plan_cache is not None
+                and not force_fresh
+                and _is_complete_reply(plan)
+                and _served_by_primary(served)
+            ):
+                plan_cache.set(cache_key, plan)
 
         step1_group = gr.Group(visible=True)
         step2_group = gr.Group(visible=False)
@@ -903,21 +3538,7 @@ def build_app() -> gr.Blocks:
             )
             injury_region = gr.Dropdown(
                 label="伤处",
-                choices=[
-                    "踝关节",
-                    "膝关节",
-                    "髋部",
-                    "下背部",
-                    "肩部",
-                    "肘部",
-                    "手腕或手",
-                    "足部",
-                    "腘绳肌",
-                    "股四头肌",
-                    "小腿",
-                    "颈部",
-                    "其他",
-                ],
+                choices=INJURY_REGIONS,
                 value="膝关节",
                 elem_classes=["required"],
             )
@@ -928,7 +3549,7 @@ def build_app() -> gr.Blocks:
             )
             onset_type = gr.Radio(
                 label="起病方式",
-                choices=["急性外伤", "过度使用", "不确定"],
+                choices=ONSET_TYPES,
                 value="急性外伤",
                 elem_classes=["required"],
             )
@@ -951,7 +3572,7 @@ def build_app() -> gr.Blocks:
             )
             training_phase = gr.Dropdown(
                 label="训练阶段",
-                choices=["赛季中", "休赛期", "季前备战", "回归训练"],
+                choices=TRAINING_PHASES,
                 value="赛季中",
             )
             prior_injury = gr.Textbox(label="既往伤史", placeholder="可选")
@@ -1008,12 +3629,12 @@ def build_app() -> gr.Blocks:
             training_goal,
         ]
 
-        send_btn.click(
+        send_event = send_btn.click(
             _send_message,
             inputs=[chat_input, chat_history] + intake_inputs,
             outputs=[chat, chat_history, chat_input],
         )
-        chat_input.submit(
+        submit_event = chat_input.submit(
             _send_message,
             inputs=[chat_input, chat_history] + intake_inputs,
             outputs=[chat, chat_history, chat_input],
@@ -1027,7 +3648,7 @@ def build_app() -> gr.Blocks:
             )
 
 
-        to_step2.click(
+        step2_event = to_step2.click(
             _enter_step2,
             inputs=intake_inputs,
             outputs=[
@@ -1041,30 +3662,40 @@ def build_app() -> gr.Blocks:
                 chat_input,
             ],
         )
-        back_to_step1.click(
-            lambda: _toggle_steps(1),
-            outputs=[step1_group, step2_group, step3_group],
-        )
-        back_to_step2.click(
-            lambda: _toggle_steps(2),
-            outputs=[step1_group, step2_group, step3_group],
-        )
-        to_step3.click(
+        plan_event = to_step3.click(
             _generate_plan,
-            inputs=[chat_history] + intake_inputs,
+            inputs=[chat_history] + intake_inputs + [gr.State(False)],
             outputs=[plan_output],
         )
         to_step3.click(
             lambda: _toggle_steps(3),
             outputs=[step1_group, step2_group, step3_group],
         )
-        regenerate_plan.click(
+        regenerate_event = regenerate_plan.click(
             _generate_plan,
-            inputs=[chat_history] + intake_inputs,
+            inputs=[chat_history] + intake_inputs + [gr.State(True)],
             outputs=[plan_output],
         )
+        back_to_step1.click(
+            lambda: _toggle_steps(1),
+            outputs=[step1_group, step2_group, step3_group],
+            cancels=[step2_event, send_event, submit_event, plan_event, regenerate_event],
+        )
+        back_to_step2.click(
+            lambda: _toggle_steps(2),
+            outputs=[step1_group, step2_group, step3_group],
+            cancels=[plan_event, regenerate_event],
+        )
+        demo.unload(_release_session_agent)
+    config = _runtime_config()
+    concurrency_limit = None
+    if config.max_concurrent_requests > 0 and config.max_queue_size >= 0:
+        concurrency_limit = config.max_concurrent_requests + config.max_queue_size
+    demo.queue(default_concurrency_limit=concurrency_limit)
     return demo
 
 
 if __name__ == "__main__":
-    build_app().launch(share=True)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, _handle_reload_signal)
+    build_app().launch(share=True, app_kwargs={"routes": METRICS_ROUTES})
@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, List
+
+import app
+
+INTAKE_FIELDS = [
+    "sport",
+    "injury_region",
+    "injury_type",
+    "onset_type",
+    "time_since",
+    "pain_score",
+    "symptoms",
+    "injury_image",
+    "training_goal",
+    "training_phase",
+    "prior_injury",
+    "treatment_done",
+    "notes",
+]
+
+
+def _read_records(path: Path) -> Iterator[dict]:
+    if path.suffix.lower() == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as handle:
+            yield from csv.DictReader(handle)
+        return
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _intake_values(record: dict) -> List:
+    symptoms = record.get("symptoms") or []
+    if isinstance(symptoms, str):
+        symptoms = [item.strip() for item in symptoms.replace("，", "、").replace(",", "、").split("、")]
+    values = {field: record.get(field) or "" for field in INTAKE_FIELDS}
+    values["pain_score"] = app._parse_int(record.get("pain_score"), 0)
+    values["symptoms"] = [item for item in symptoms if item]
+    return [values[field] for field in INTAKE_FIELDS]
+
+
+def _completed_ids(path: Path) -> set:
+    done = set()
+    if not path.exists():
+        return done
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get("status") == "ok":
+                done.add(str(result.get("id")))
+    return done
+
+
+def _compact_results(path: Path) -> None:
+    latest: dict[str, str] = {}
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            latest[str(result.get("id"))] = line if line.endswith("\n") else f"{line}\n"
+    temporary = path.with_name(f"{path.name}.tmp")
+    with open(temporary, "w", encoding="utf-8") as handle:
+        handle.writelines(latest.values())
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temporary, path)
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class _RateLimiter:
+    def __init__(self, per_second: float) -> None:
+        self._interval = 1 / per_second if per_second > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self._interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def _generate(record_id: str, values: List, config: app.RuntimeConfig) -> dict:
+    started = time.perf_counter()
+    first_token = None
+    plan = ""
+    plan_cache = app._get_plan_cache(config)
+    cache_key = app._plan_cache_key(app.PLAN_REQUEST, [], values, config)
+    cached = plan_cache.get(cache_key) if plan_cache is not None else None
+    if cached:
+        plan, first_token = cached, time.perf_counter()
+    else:
+        served: List[str] = []
+        async for partial in app._plan_stream([], values, None, "batch", config, served):
+            if first_token is None and partial:
+                first_token = time.perf_counter()
+            plan = partial
+        if (
+            plan_cache is not None
+            and app._is_complete_reply(plan)
+            and app._served_by_primary(served)
+        ):
+            plan_cache.set(cache_key, plan)
+    finished = time.perf_counter()
+    return {
+        "id": record_id,
+        "status": "ok" if app._is_complete_reply(plan) else "error",
+        "plan": plan,
+        "cached": bool(cached),
+        "ttft_ms": round(((first_token or finished) - started) * 1000, 1),
+        "latency_ms": round((finished - started) * 1000, 1),
+    }
+
+
+async def run_batch(
+    input_path: Path,
+    output_path: Path,
+    workers: int,
+    rate: float,
+    resume: bool,
+) -> dict:
+    config = app._runtime_config()
+    if not config.api_key:
+        raise SystemExit("缺少 API Key。请设置 ANTHROPIC_API_KEY 或在 config.local.yaml 中填写 api_key。")
+    done = _completed_ids(output_path) if resume else set()
+    queue: asyncio.Queue = asyncio.Queue()
+    skipped = 0
+    duplicates = 0
+    queued: set = set()
+    for index, record in enumerate(_read_records(input_path), start=1):
+        record_id = str(record.get("id") or index)
+        if record_id in queued:
+            duplicates += 1
+            print(f"Duplicate id {record_id} at row {index}; keeping the first.", file=sys.stderr)
+            continue
+        queued.add(record_id)
+        if record_id in done:
+            skipped += 1
+            continue
+        queue.put_nowait((record_id, record))
+
+    limiter = _RateLimiter(rate)
+    latencies: List[float] = []
+    ttfts: List[float] = []
+    counts = {"ok": 0, "error": 0}
+    started = time.perf_counter()
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as output:
+
+        def _write(result: dict) -> None:
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            os.fsync(output.fileno())
+
+        async def _worker() -> None:
+            while True:
+                try:
+                    record_id, record = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await limiter.wait()
+                attempt_started = time.perf_counter()
+                try:
+                    result = await _generate(record_id, _intake_values(record), config)
+                except Exception as exc:
+                    elapsed_ms = round((time.perf_counter() - attempt_started) * 1000, 1)
+                    result = {
+                        "id": record_id,
+                        "status": "error",
+                        "error": str(exc),
+                        "ttft_ms": elapsed_ms,
+                        "latency_ms": elapsed_ms,
+                    }
+                counts[result["status"]] += 1
+                latencies.append(result["latency_ms"])
+                ttfts.append(result["ttft_ms"])
+                _write(result)
+                print(
+                    f"[{counts['ok'] + counts['error']}] {record_id} {result['status']} "
+                    f"{result.get('latency_ms', '-')} ms",
+                    file=sys.stderr,
+                )
+
+        await asyncio.gather(*(_worker() for _ in range(max(1, workers))))
+
+    _compact_results(output_path)
+    return {
+        "ok": counts["ok"],
+        "error": counts["error"],
+        "skipped": skipped,
+        "duplicates": duplicates,
+        "seconds": round(time.perf_counter() - started, 1),
+        "latency_ms": {
+            "p50": _percentile(latencies, 0.5),
+            "p95": _percentile(latencies, 0.95),
+            "max": max(latencies, default=0.0),
+        },
+        "ttft_ms": {
+            "p50": _percentile(ttfts, 0.5),
+            "p95": _percentile(ttfts, 0.95),
+        },
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate rehab plans for a batch of intakes.")
+    parser.add_argument("input", type=Path, help="Intakes as JSONL or CSV (one athlete per row).")
+    parser.add_argument("--output", type=Path, default=None, help="Result JSONL path.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="Maximum new requests per second (0 = unlimited).",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Start over instead of skipping ids already completed in the output file.",
+    )
+    args = parser.parse_args(argv)
+    output = args.output or args.input.with_name(f"{args.input.stem}.results.jsonl")
+    stats = asyncio.run(
+        run_batch(args.input, output, args.workers, args.rate, not args.no_resume)
+    )
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
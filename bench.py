@@ -0,0 +1,418 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, List
+
+from claude_agent_sdk import ClaudeAgentOptions, Transport
+
+import app
+
+MOCK_TOKEN = "康复"
+SECTION_MARKER = "本次只输出其中"
+PLAN_MARKERS = (app.PLAN_REQUEST, "基础康复方案模板")
+SAMPLE_ANSWERS = ["膝盖内侧疼，上下楼梯加重。", "没有打软腿，能正常走路。", "冰敷后肿胀减轻了一些。"]
+
+
+@dataclass
+class MockProfile:
+    tokens_per_second: float = 40.0
+    jitter: float = 0.3
+    first_token_ms: float = 400.0
+    interview_tokens: int = 40
+    plan_tokens: int = 400
+
+
+class _ProcessCounter:
+    def __init__(self) -> None:
+        self.spawned = 0
+        self.active = 0
+        self.peak = 0
+
+    def connect(self) -> None:
+        self.spawned += 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    def disconnect(self) -> None:
+        self.active -= 1
+
+
+class MockTransport(Transport):
+    def __init__(
+        self,
+        prompt: str | AsyncIterator[dict] | None,
+        options: ClaudeAgentOptions,
+        profile: MockProfile,
+        counter: _ProcessCounter,
+    ) -> None:
+        self._prompt = prompt
+        self._options = options
+        self._profile = profile
+        self._counter = counter
+        self._one_shot = prompt is not None
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._tasks: set[asyncio.Task] = set()
+        self._ready = False
+        self._session_id = uuid.uuid4().hex
+
+    async def connect(self) -> None:
+        self._ready = True
+        self._counter.connect()
+        if isinstance(self._prompt, str):
+            self._spawn(self._prompt)
+
+    def _spawn(self, text: str) -> None:
+        task = asyncio.create_task(self._reply(text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reply(self, text: str) -> None:
+        profile = self._profile
+        started = time.perf_counter()
+        if text.strip() == app.AGENT_RESET_COMMAND:
+            tokens = 0
+        elif SECTION_MARKER in text:
+            tokens = max(1, profile.plan_tokens // len(app.PLAN_SECTIONS))
+        elif any(marker in text for marker in PLAN_MARKERS):
+            tokens = profile.plan_tokens
+        else:
+            tokens = profile.interview_tokens
+        if tokens:
+            await asyncio.sleep(profile.first_token_ms / 1000)
+        for _ in range(tokens):
+            await self._messages.put(
+                {
+                    "type": "stream_event",
+                    "uuid": uuid.uuid4().hex,
+                    "session_id": self._session_id,
+                    "event": {
+                        "type": "content_block_delta",
+                        "index": 0,
+                        "delta": {"type": "text_delta", "text": MOCK_TOKEN},
+                    },
+                }
+            )
+            jitter = 1 + random.uniform(-profile.jitter, profile.jitter)
+            await asyncio.sleep(max(jitter, 0) / profile.tokens_per_second)
+        reply = MOCK_TOKEN * tokens
+        if reply:
+            await self._messages.put(
+                {
+                    "type": "assistant",
+                    "message": {
+                        "role": "assistant",
+                        "model": self._options.model or "mock",
+                        "content": [{"type": "text", "text": reply}],
+                    },
+                }
+            )
+        elapsed_ms = int((time.perf_counter() - started) * 1000)
+        await self._messages.put(
+            {
+                "type": "result",
+                "subtype": "success",
+                "duration_ms": elapsed_ms,
+                "duration_api_ms": elapsed_ms,
+                "is_error": False,
+                "num_turns": 1,
+                "session_id": self._session_id,
+                "total_cost_usd": 0.0,
+                "usage": {"input_tokens": app._estimate_tokens(text), "output_tokens": tokens},
+                "result": reply,
+            }
+        )
+        if self._one_shot:
+            await self._messages.put(None)
+
+    async def write(self, data: str) -> None:
+        message = json.loads(data)
+        if message.get("type") == "control_request":
+            request = message.get("request", {})
+            interrupted = request.get("subtype") == "interrupt" and bool(self._tasks)
+            if interrupted:
+                for task in list(self._tasks):
+                    task.cancel()
+            await self._messages.put(
+                {
+                    "type": "control_response",
+                    "response": {
+                        "subtype": "success",
+                        "request_id": message.get("request_id"),
+                        "response": {},
+                    },
+                }
+            )
+            if interrupted:
+                await self._messages.put(
+                    {
+                        "type": "result",
+                        "subtype": "error_during_execution",
+                        "duration_ms": 0,
+                        "duration_api_ms": 0,
+                        "is_error": True,
+                        "num_turns": 1,
+                        "session_id": self._session_id,
+                    }
+                )
+            return
+        if message.get("type") == "user":
+            content = message.get("message", {}).get("content", "")
+            if isinstance(content, list):
+                content = "".join(
+                    block.get("text", "") for block in content if isinstance(block, dict)
+                )
+            self._spawn(str(content))
+
+    async def read_messages(self) -> AsyncIterator[dict[str, Any]]:
+        while True:
+            message = await self._messages.get()
+            if message is None:
+                return
+            yield message
+
+    async def close(self) -> None:
+        if not self._ready:
+            return
+        self._ready = False
+        self._counter.disconnect()
+        for task in list(self._tasks):
+            task.cancel()
+        self._messages.put_nowait(None)
+
+    def is_ready(self) -> bool:
+        return self._ready
+
+    async def end_input(self) -> None:
+        return None
+
+
+def _child_process_count() -> int | None:
+    path = Path(f"/proc/{os.getpid()}/task")
+    if not path.exists():
+        return None
+    count = 0
+    for task in path.iterdir():
+        try:
+            count += len((task / "children").read_text().split())
+        except OSError:
+            continue
+    return count
+
+
+def _percentiles(values: List[float]) -> dict:
+    ordered = sorted(values)
+    if not ordered:
+        return {"p50": None, "p95": None, "p99": None, "count": 0}
+
+    def _at(fraction: float) -> float:
+        index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+        return round(ordered[index] * 1000, 1)
+
+    return {"p50": _at(0.5), "p95": _at(0.95), "p99": _at(0.99), "count": len(ordered)}
+
+
+def _is_placeholder(text: str) -> bool:
+    return not text or text.startswith("排队中") or text == "正在生成方案，请稍候…"
+
+
+def _intake(user: int) -> list:
+    region = app.INJURY_REGIONS[user % (len(app.INJURY_REGIONS) - 1)]
+    return [
+        ["足球", "篮球", "跑步", "网球"][user % 4],
+        region,
+        ["扭伤", "拉伤", "肌腱炎"][user % 3],
+        app.ONSET_TYPES[user % 2],
+        f"{user % 14 + 1} 天",
+        3 + user % 4,
+        ["肿胀"] if user % 2 else [],
+        "",
+        f"{4 + user % 6} 周内回归比赛",
+        app.TRAINING_PHASES[user % len(app.TRAINING_PHASES)],
+        "",
+        "休息、冰敷",
+        f"模拟用户 {user}",
+    ]
+
+
+class _Recorder:
+    def __init__(self) -> None:
+        self.ttft: dict[str, List[float]] = {}
+        self.latency: dict[str, List[float]] = {}
+        self.flows: List[float] = []
+        self.errors = 0
+
+    async def measure(self, stage: str, source: AsyncIterator, text_of) -> Any:
+        started = time.perf_counter()
+        first = None
+        last = None
+        async for value in source:
+            last = value
+            if first is None and not _is_placeholder(text_of(value)):
+                first = time.perf_counter()
+        finished = time.perf_counter()
+        self.ttft.setdefault(stage, []).append((first or finished) - started)
+        self.latency.setdefault(stage, []).append(finished - started)
+        return last
+
+
+async def _simulate_user(handlers: dict, user: int, turns: int, recorder: _Recorder) -> None:
+    request = SimpleNamespace(session_hash=f"bench-{user}-{uuid.uuid4().hex[:8]}")
+    intake = _intake(user)
+    started = time.perf_counter()
+    try:
+        step2 = await recorder.measure(
+            "step2",
+            handlers["_enter_step2"](*intake, request=request),
+            lambda value: value[5][-1]["content"] if value[5] else "",
+        )
+        history = step2[6]
+        for turn in range(turns):
+            result = await recorder.measure(
+                "interview",
+                handlers["_send_message"](
+                    SAMPLE_ANSWERS[turn % len(SAMPLE_ANSWERS)],
+                    history,
+                    *intake,
+                    request=request,
+                ),
+                lambda value: value[0][-1]["content"] if value[0] else "",
+            )
+            history = result[1]
+        await recorder.measure(
+            "plan",
+            handlers["_generate_plan"](history, *intake, False, request=request),
+            lambda value: value,
+        )
+        recorder.flows.append(time.perf_counter() - started)
+    except Exception as exc:
+        recorder.errors += 1
+        print(f"user {user} failed: {exc!r}", file=sys.stderr)
+    finally:
+        await app._release_session_agent(request)
+
+
+async def run_benchmark(users: int, concurrency: int, turns: int, live: bool, profile: MockProfile) -> dict:
+    counter = _ProcessCounter()
+    if not live:
+        os.environ.setdefault("ANTHROPIC_API_KEY", "mock")
+        app.AGENT_TRANSPORT_FACTORY = lambda prompt, options: MockTransport(
+            prompt, options, profile, counter
+        )
+    demo = app.build_app()
+    handlers = {}
+    for block_fn in demo.fns.values():
+        handlers.setdefault(getattr(block_fn.fn, "__name__", ""), block_fn.fn)
+
+    recorder = _Recorder()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    peak_children = 0
+    sampling = True
+
+    async def _sample() -> None:
+        nonlocal peak_children
+        while sampling:
+            peak_children = max(peak_children, _child_process_count() or 0)
+            await asyncio.sleep(0.2)
+
+    async def _bounded(user: int) -> None:
+        async with semaphore:
+            await _simulate_user(handlers, user, turns, recorder)
+
+    sampler = asyncio.create_task(_sample())
+    started = time.perf_counter()
+    await asyncio.gather(*(_bounded(user) for user in range(users)))
+    wall = time.perf_counter() - started
+    sampling = False
+    await sampler
+
+    calls = sum(len(values) for values in recorder.latency.values())
+    config = app._runtime_config()
+    return {
+        "backend": "live" if live else "mock",
+        "users": users,
+        "concurrency": concurrency,
+        "interview_turns": turns,
+        "mock_profile": None if live else asdict(profile),
+        "config": {
+            "agent_pool_size": config.agent_pool_size,
+            "max_concurrent_requests": config.max_concurrent_requests,
+            "speculative_plan": config.speculative_plan,
+            "parallel_plan_sections": config.parallel_plan_sections,
+        },
+        "wall_seconds": round(wall, 3),
+        "completed_flows": len(recorder.flows),
+        "errors": recorder.errors,
+        "throughput": {
+            "flows_per_second": round(len(recorder.flows) / wall, 3),
+            "handler_calls_per_second": round(calls / wall, 3),
+        },
+        "ttft_ms": {stage: _percentiles(values) for stage, values in recorder.ttft.items()},
+        "latency_ms": {stage: _percentiles(values) for stage, values in recorder.latency.items()},
+        "flow_latency_ms": _percentiles(recorder.flows),
+        "agent_processes": {
+            "spawned": counter.spawned if not live else None,
+            "peak_concurrent": counter.peak if not live else peak_children,
+        },
+        "routes": app._ROUTE_STATS.snapshot(),
+    }
+
+
+def _compare(result: dict, baseline: dict) -> List[str]:
+    lines = []
+    for section in ("ttft_ms", "latency_ms"):
+        for stage, values in result[section].items():
+            before = baseline.get(section, {}).get(stage, {})
+            for key in ("p50", "p95", "p99"):
+                if values.get(key) is not None and before.get(key):
+                    change = (values[key] - before[key]) / before[key] * 100
+                    lines.append(
+                        f"{section}.{stage}.{key}: {before[key]} -> {values[key]} ({change:+.1f}%)"
+                    )
+    return lines
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the step 1 -> 2 -> 3 consultation flow.")
+    parser.add_argument("--users", type=int, default=20, help="Simulated users in total.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Users running at once.")
+    parser.add_argument("--turns", type=int, default=2, help="Interview answers per user.")
+    parser.add_argument("--live", action="store_true", help="Call the configured model backend.")
+    parser.add_argument("--tokens-per-second", type=float, default=MockProfile.tokens_per_second)
+    parser.add_argument("--jitter", type=float, default=MockProfile.jitter)
+    parser.add_argument("--first-token-ms", type=float, default=MockProfile.first_token_ms)
+    parser.add_argument("--interview-tokens", type=int, default=MockProfile.interview_tokens)
+    parser.add_argument("--plan-tokens", type=int, default=MockProfile.plan_tokens)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="Write the JSON result here.")
+    parser.add_argument("--baseline", type=Path, default=None, help="Compare against a prior result.")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    profile = MockProfile(
+        tokens_per_second=args.tokens_per_second,
+        jitter=args.jitter,
+        first_token_ms=args.first_token_ms,
+        interview_tokens=args.interview_tokens,
+        plan_tokens=args.plan_tokens,
+    )
+    result = asyncio.run(
+        run_benchmark(args.users, args.concurrency, args.turns, args.live, profile)
+    )
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n", encoding="utf-8")
+    print(text)
+    if args.baseline:
+        for line in _compare(result, json.loads(args.baseline.read_text(encoding="utf-8"))):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,515 @@
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent
+DEFAULT_SOURCES = [
+    PROJECT_ROOT / "data" / "knowledge",
+    PROJECT_ROOT / "data" / "rehab-docs",
+]
+DEFAULT_INDEX_PATH = PROJECT_ROOT / "dist" / "knowledge_index"
+INDEX_FILE = "index.json"
+TEXT_SUFFIXES = {".txt", ".md", ".markdown"}
+HTML_SUFFIXES = {".html", ".htm"}
+PDF_SUFFIXES = {".pdf"}
+CHUNK_CHARS = 500
+CHUNK_OVERLAP = 100
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_SEGMENTS = 8
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[㐀-鿿]+")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens: List[str] = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        run = match.group()
+        if run[0].isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[index : index + 2] for index in range(len(run) - 1))
+    return tokens
+
+
+class _HTMLText(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag in ("script", "style", "nav", "footer"):
+            self._skip += 1
+        elif tag in ("p", "br", "div", "li", "h1", "h2", "h3", "h4", "tr"):
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in ("script", "style", "nav", "footer") and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data: str) -> None:
+        if not self._skip:
+            self.parts.append(data)
+
+
+def _read_pdf(path: Path) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError as exc:
+        raise RuntimeError("PDF 解析需要安装 pypdf：pip install pypdf") from exc
+    reader = PdfReader(str(path))
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def extract_text(path: Path) -> str:
+    suffix = path.suffix.lower()
+    if suffix in PDF_SUFFIXES:
+        return _read_pdf(path)
+    raw = path.read_text(encoding="utf-8", errors="ignore")
+    if suffix in HTML_SUFFIXES:
+        parser = _HTMLText()
+        parser.feed(raw)
+        return "".join(parser.parts)
+    return raw
+
+
+def clean_text(text: str) -> str:
+    paragraphs = []
+    for block in re.split(r"\n\s*\n|\r\n\s*\r\n", text):
+        collapsed = " ".join(block.split())
+        if len(collapsed) >= 4:
+            paragraphs.append(collapsed)
+    return "\n\n".join(paragraphs)
+
+
+def chunk_text(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    chunks: List[str] = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > size:
+            head, paragraph = paragraph[:size], paragraph[size - overlap :]
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(head)
+        if current and len(current) + len(paragraph) + 1 > size:
+            chunks.append(current)
+            current = current[-overlap:] if overlap else ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+def iter_documents(sources: Iterable[Path]) -> Iterator[Path]:
+    suffixes = TEXT_SUFFIXES | HTML_SUFFIXES | PDF_SUFFIXES
+    for source in sources:
+        if source.is_file():
+            yield source
+            continue
+        if not source.is_dir():
+            continue
+        for path in sorted(source.rglob("*")):
+            if path.is_file() and path.suffix.lower() in suffixes:
+                yield path
+
+
+def _source_label(path: Path) -> str:
+    try:
+        return str(path.resolve().relative_to(PROJECT_ROOT))
+    except ValueError:
+        return str(path)
+
+
+def write_segment(directory: Path, name: str, chunks: List[tuple[str, str]]) -> dict:
+    postings: dict[str, list[tuple[int, int]]] = {}
+    chunk_meta = []
+    text_blob = bytearray()
+    total_length = 0
+    for chunk_id, (source, text) in enumerate(chunks):
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        total_length += length
+        encoded = text.encode("utf-8")
+        chunk_meta.append([source, len(text_blob), len(encoded), length])
+        text_blob.extend(encoded)
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((chunk_id, min(tf, 0xFFFF)))
+
+    terms = {}
+    values = array("I")
+    for term in sorted(postings):
+        entries = postings[term]
+        terms[term] = [len(entries), len(values)]
+        for chunk_id, tf in entries:
+            values.append(chunk_id)
+            values.append(tf)
+
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / f"{name}.bin", "wb") as handle:
+        values.tofile(handle)
+        handle.write(text_blob)
+    header = {
+        "version": 1,
+        "chunk_count": len(chunk_meta),
+        "total_length": total_length,
+        "text_offset": len(values) * values.itemsize,
+        "terms": terms,
+        "chunks": chunk_meta,
+    }
+    (directory / f"{name}.json").write_text(json.dumps(header, ensure_ascii=False), encoding="utf-8")
+    return header
+
+
+@dataclass(frozen=True)
+class Passage:
+    source: str
+    text: str
+    score: float
+
+
+class _Segment:
+    def __init__(self, directory: Path, name: str) -> None:
+        header = json.loads((directory / f"{name}.json").read_text(encoding="utf-8"))
+        self.chunk_count = int(header["chunk_count"])
+        self.total_length = int(header["total_length"])
+        self.terms: dict[str, list[int]] = header["terms"]
+        self.chunks: list[list] = header["chunks"]
+        self._text_offset = int(header["text_offset"])
+        self._handle = open(directory / f"{name}.bin", "rb")
+        size = os.fstat(self._handle.fileno()).st_size
+        self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._postings = (
+            memoryview(self._map)[: self._text_offset].cast("I") if self._map else memoryview(b"")
+        )
+
+    def postings(self, term: str) -> memoryview | None:
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        count, offset = entry
+        return self._postings[offset : offset + count * 2]
+
+    def text(self, chunk_id: int) -> str:
+        _, start, length, _ = self.chunks[chunk_id]
+        begin = self._text_offset + start
+        return bytes(self._map[begin : begin + length]).decode("utf-8")
+
+    def close(self) -> None:
+        self._postings.release()
+        if self._map is not None:
+            self._map.close()
+        self._handle.close()
+
+
+class KnowledgeIndex:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        meta = json.loads((path / INDEX_FILE).read_text(encoding="utf-8"))
+        documents = meta.get("documents")
+        self.segments = [_Segment(path, name) for name in meta.get("segments", [])]
+        self._live: List[bytearray | None] = []
+        self.chunk_count = 0
+        total_length = 0
+        for name, segment in zip(meta.get("segments", []), self.segments):
+            if documents is None:
+                live = None
+                self.chunk_count += segment.chunk_count
+                total_length += segment.total_length
+            else:
+                live = bytearray(
+                    documents.get(chunk[0], {}).get("segment") == name for chunk in segment.chunks
+                )
+                for chunk, alive in zip(segment.chunks, live):
+                    if alive:
+                        self.chunk_count += 1
+                        total_length += chunk[3]
+            self._live.append(live)
+        self.avg_length = total_length / self.chunk_count if self.chunk_count else 0.0
+
+    def search(self, query: str, top_k: int = 4, budget_ms: float | None = None) -> List[Passage]:
+        if not self.chunk_count or top_k <= 0:
+            return []
+        deadline = time.perf_counter() + budget_ms / 1000 if budget_ms else None
+        weighted = []
+        for term, query_tf in Counter(tokenize(query)).items():
+            df = sum(segment.terms.get(term, (0, 0))[0] for segment in self.segments)
+            if df:
+                df = min(df, self.chunk_count)
+                idf = math.log(1 + (self.chunk_count - df + 0.5) / (df + 0.5))
+                weighted.append((idf * query_tf, term))
+        weighted.sort(reverse=True)
+
+        scores: dict[tuple[int, int], float] = {}
+        for weight, term in weighted:
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            for segment_id, segment in enumerate(self.segments):
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+                postings = segment.postings(term)
+                if postings is None:
+                    continue
+                live = self._live[segment_id]
+                for index in range(0, len(postings), 2):
+                    chunk_id, tf = postings[index], postings[index + 1]
+                    if live is not None and not live[chunk_id]:
+                        continue
+                    length = segment.chunks[chunk_id][3]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (self.avg_length or 1))
+                    key = (segment_id, chunk_id)
+                    scores[key] = scores.get(key, 0.0) + weight * tf * (BM25_K1 + 1) / (tf + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [
+            Passage(
+                source=self.segments[segment_id].chunks[chunk_id][0],
+                text=self.segments[segment_id].text(chunk_id),
+                score=score,
+            )
+            for (segment_id, chunk_id), score in best
+        ]
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.close()
+
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _process_document(path: str, label: str, known_digest: str | None) -> dict:
+    source = Path(path)
+    stat = source.stat()
+    result = {
+        "label": label,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": _file_digest(source),
+        "chunks": None,
+        "error": None,
+    }
+    if result["sha256"] == known_digest:
+        return result
+    try:
+        result["chunks"] = chunk_text(clean_text(extract_text(source)))
+    except Exception as exc:
+        result["error"] = str(exc)
+    return result
+
+
+def _read_manifest(output: Path) -> dict:
+    try:
+        meta = json.loads((output / INDEX_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"segments": [], "documents": {}}
+    meta.setdefault("segments", [])
+    meta.setdefault("documents", {})
+    return meta
+
+
+def _write_manifest(output: Path, meta: dict) -> None:
+    output.mkdir(parents=True, exist_ok=True)
+    temp_path = output / f"{INDEX_FILE}.tmp"
+    temp_path.write_text(json.dumps(meta, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(temp_path, output / INDEX_FILE)
+
+
+def _next_segment_name(meta: dict) -> str:
+    numbers = [int(name.rsplit("-", 1)[-1]) for name in meta["segments"]]
+    return f"segment-{max(numbers, default=0) + 1:06d}"
+
+
+def _remove_segments(output: Path, names: Iterable[str]) -> None:
+    for name in names:
+        for suffix in (".json", ".bin"):
+            try:
+                (output / f"{name}{suffix}").unlink()
+            except OSError:
+                pass
+
+
+def _drop_unused_segments(output: Path, meta: dict) -> None:
+    used = {entry.get("segment") for entry in meta["documents"].values()}
+    unused = [name for name in meta["segments"] if name not in used]
+    if unused:
+        meta["segments"] = [name for name in meta["segments"] if name in used]
+        _write_manifest(output, meta)
+        _remove_segments(output, unused)
+
+
+def merge_segments(output: Path) -> dict:
+    started = time.perf_counter()
+    meta = _read_manifest(output)
+    old_segments = list(meta["segments"])
+    chunks: List[tuple[str, str]] = []
+    for name in old_segments:
+        segment = _Segment(output, name)
+        for chunk_id, chunk in enumerate(segment.chunks):
+            if meta["documents"].get(chunk[0], {}).get("segment") == name:
+                chunks.append((chunk[0], segment.text(chunk_id)))
+    name = _next_segment_name(meta)
+    write_segment(output, name, chunks)
+    for entry in meta["documents"].values():
+        entry["segment"] = name
+    meta["segments"] = [name]
+    _write_manifest(output, meta)
+    _remove_segments(output, old_segments)
+    return {
+        "merged_segments": len(old_segments),
+        "chunks": len(chunks),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def build_index(
+    sources: Iterable[Path],
+    output: Path,
+    workers: int | None = None,
+    full: bool = False,
+    max_segments: int = MAX_SEGMENTS,
+) -> dict:
+    started = time.perf_counter()
+    meta = _read_manifest(output)
+    if full:
+        meta = {"segments": meta["segments"], "documents": {}}
+    documents: dict = meta["documents"]
+
+    seen = set()
+    pending = []
+    for path in iter_documents(sources):
+        label = _source_label(path)
+        seen.add(label)
+        entry = documents.get(label)
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            continue
+        pending.append((str(path), label, entry.get("sha256") if entry else None))
+    removed = [label for label in documents if label not in seen]
+    for label in removed:
+        documents.pop(label)
+
+    results = []
+    if len(pending) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_process_document, *item) for item in pending]
+            results = [future.result() for future in futures]
+    else:
+        results = [_process_document(*item) for item in pending]
+
+    name = _next_segment_name(meta)
+    chunks: List[tuple[str, str]] = []
+    processed = 0
+    processed_bytes = 0
+    failed = 0
+    for result in results:
+        label = result["label"]
+        if result["error"]:
+            print(f"跳过 {label}: {result['error']}")
+            failed += 1
+            documents.pop(label, None)
+            continue
+        entry = {
+            "sha256": result["sha256"],
+            "size": result["size"],
+            "mtime_ns": result["mtime_ns"],
+            "segment": documents.get(label, {}).get("segment"),
+        }
+        if result["chunks"] is not None:
+            processed += 1
+            processed_bytes += result["size"]
+            chunks.extend((label, chunk) for chunk in result["chunks"])
+            entry["segment"] = name
+        documents[label] = entry
+
+    if chunks:
+        write_segment(output, name, chunks)
+        meta["segments"].append(name)
+    _write_manifest(output, meta)
+    _drop_unused_segments(output, meta)
+    merged = None
+    if max_segments and len(meta["segments"]) > max_segments:
+        merged = merge_segments(output)
+
+    seconds = max(time.perf_counter() - started, 1e-9)
+    stats = {
+        "documents": len(documents),
+        "processed": processed,
+        "unchanged": len(documents) - processed,
+        "removed": len(removed),
+        "failed": failed,
+        "chunks": len(chunks),
+        "segments": len(_read_manifest(output)["segments"]),
+        "bytes": processed_bytes,
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(processed / seconds, 1),
+        "bytes_per_second": round(processed_bytes / seconds, 1),
+    }
+    if merged:
+        stats["merged"] = merged
+    return stats
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Build the local rehab knowledge index.")
+    parser.add_argument(
+        "--source",
+        action="append",
+        type=Path,
+        help="Document directory or file (default: data/knowledge and data/rehab-docs).",
+    )
+    parser.add_argument("--output", type=Path, default=DEFAULT_INDEX_PATH)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes for extraction and chunking (default: CPU count).",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-process every document instead of only new or changed ones.",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge all segments into one without re-processing documents.",
+    )
+    args = parser.parse_args(argv)
+    if args.merge:
+        stats = merge_segments(args.output)
+    else:
+        stats = build_index(
+            args.source or DEFAULT_SOURCES,
+            args.output,
+            workers=args.workers,
+            full=args.full,
+        )
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
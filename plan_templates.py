@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+from knowledge import tokenize
+
+PROJECT_ROOT = Path(__file__).resolve().parent
+DEFAULT_TEMPLATES_PATH = PROJECT_ROOT / "dist" / "plan_templates.sqlite3"
+TEMPLATE_INJURY_TYPES = ["扭伤", "拉伤", "肌腱病", "挫伤"]
+TEMPLATE_SPORT = "通用（不限项目）"
+TEMPLATE_GOAL = "安全回归原运动水平"
+TEMPLATE_REQUEST = (
+    "为具有上述伤处、损伤类型、起病方式与训练阶段的一般运动员生成基础的阶段化康复方案模板，"
+    "包含进阶标准、回归运动清单与清晰的风险红旗。不要针对具体个人，不要提问，"
+    "不要调用工具，直接输出方案。"
+)
+MIN_TYPE_SIMILARITY = 0.5
+
+
+@dataclass(frozen=True)
+class PlanTemplate:
+    injury_region: str
+    injury_type: str
+    onset_type: str
+    training_phase: str
+    plan: str
+
+    @property
+    def label(self) -> str:
+        return " · ".join(
+            (self.injury_region, self.injury_type, self.onset_type, self.training_phase)
+        )
+
+
+def _type_similarity(left: str, right: str) -> float:
+    left_terms = set(tokenize(left))
+    right_terms = set(tokenize(right))
+    if not left_terms or not right_terms:
+        return 0.0
+    return len(left_terms & right_terms) / min(len(left_terms), len(right_terms))
+
+
+class PlanTemplateStore:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS plan_templates ("
+            "injury_region TEXT NOT NULL, injury_type TEXT NOT NULL, "
+            "onset_type TEXT NOT NULL, training_phase TEXT NOT NULL, "
+            "plan TEXT NOT NULL, model TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (injury_region, injury_type, onset_type, training_phase))"
+        )
+        self._by_region: dict[str, List[PlanTemplate]] | None = None
+
+    def _load(self) -> dict[str, List[PlanTemplate]]:
+        if self._by_region is None:
+            by_region: dict[str, List[PlanTemplate]] = {}
+            for row in self._conn.execute(
+                "SELECT injury_region, injury_type, onset_type, training_phase, plan "
+                "FROM plan_templates"
+            ):
+                by_region.setdefault(row[0], []).append(PlanTemplate(*row))
+            self._by_region = by_region
+        return self._by_region
+
+    def __len__(self) -> int:
+        return sum(len(templates) for templates in self._load().values())
+
+    def has(self, injury_region: str, injury_type: str, onset_type: str, training_phase: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM plan_templates WHERE injury_region = ? AND injury_type = ? "
+            "AND onset_type = ? AND training_phase = ?",
+            (injury_region, injury_type, onset_type, training_phase),
+        ).fetchone()
+        return row is not None
+
+    def put(self, template: PlanTemplate, model: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO plan_templates "
+            "(injury_region, injury_type, onset_type, training_phase, plan, model, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                template.injury_region,
+                template.injury_type,
+                template.onset_type,
+                template.training_phase,
+                template.plan,
+                model,
+                time.time(),
+            ),
+        )
+        self._by_region = None
+
+    def nearest(
+        self,
+        injury_region: str,
+        injury_type: str,
+        onset_type: str,
+        training_phase: str,
+    ) -> PlanTemplate | None:
+        best = None
+        best_score = 0.0
+        for template in self._load().get(injury_region or "", []):
+            similarity = _type_similarity(injury_type or "", template.injury_type)
+            if similarity < MIN_TYPE_SIMILARITY:
+                continue
+            score = similarity * 4
+            score += 2 if template.onset_type == onset_type else 0
+            score += 1 if template.training_phase == training_phase else 0
+            if score > best_score:
+                best, best_score = template, score
+        return best
+
+
+def _template_intake(injury_region: str, injury_type: str, onset_type: str, training_phase: str) -> list:
+    return [
+        TEMPLATE_SPORT,
+        injury_region,
+        injury_type,
+        onset_type,
+        "",
+        4,
+        [],
+        None,
+        TEMPLATE_GOAL,
+        training_phase,
+        "",
+        "",
+        "",
+    ]
+
+
+async def build_templates(
+    path: Path,
+    injury_types: List[str],
+    concurrency: int,
+    refresh: bool,
+    limit: int | None,
+) -> dict:
+    import app
+
+    config = app._runtime_config()
+    if not config.api_key:
+        raise SystemExit("缺少 API Key。请设置 ANTHROPIC_API_KEY 或在 config.local.yaml 中填写 api_key。")
+    model = app.BackendConfig.from_runtime(config, app._route_name("template")).model
+    store = PlanTemplateStore(path)
+    combinations = [
+        (region, injury_type, onset_type, phase)
+        for region in app.INJURY_REGIONS
+        if region != "其他"
+        for injury_type in injury_types
+        for onset_type in app.ONSET_TYPES
+        for phase in app.TRAINING_PHASES
+    ]
+    if not refresh:
+        combinations = [combo for combo in combinations if not store.has(*combo)]
+    if limit is not None:
+        combinations = combinations[:limit]
+
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    stats = {"requested": len(combinations), "stored": 0, "failed": 0}
+
+    async def _generate(combo: tuple) -> None:
+        async with semaphore:
+            text = ""
+            async for partial in app.respond(
+                TEMPLATE_REQUEST,
+                [],
+                *_template_intake(*combo),
+                call_type="template",
+            ):
+                text = partial
+            if app._is_complete_reply(text):
+                store.put(PlanTemplate(*combo, plan=text), model)
+                stats["stored"] += 1
+                print(f"已生成 {' · '.join(combo)}")
+            else:
+                stats["failed"] += 1
+                print(f"生成失败 {' · '.join(combo)}: {text[:80]}")
+
+    await asyncio.gather(*(_generate(combo) for combo in combinations))
+    stats["templates"] = len(store)
+    stats["seconds"] = round(time.perf_counter() - started, 1)
+    return stats
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Pre-generate base rehab plan templates.")
+    parser.add_argument("--output", type=Path, default=DEFAULT_TEMPLATES_PATH)
+    parser.add_argument(
+        "--types",
+        nargs="+",
+        default=TEMPLATE_INJURY_TYPES,
+        help="Injury types to cover for every region, onset and phase.",
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=None, help="Generate at most N templates.")
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Regenerate templates that already exist in the store.",
+    )
+    args = parser.parse_args(argv)
+    stats = asyncio.run(
+        build_templates(args.output, args.types, args.concurrency, args.refresh, args.limit)
+    )
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()